@@ -1,2 +1,2 @@
-__all__ = ["pipeline", "pipeline_executor", "queueing", "file_handling", "application"]
+__all__ = ["pipeline", "pipeline_executor", "queueing", "file_handling", "application", "stage_graph", "journal", "stage_state", "resource_model", "pipeline_report", "cpu_affinity", "staging"]
 
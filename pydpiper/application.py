@@ -7,7 +7,6 @@ from datetime import datetime
 import time # TODO why both datetime and time?
 from pkg_resources import get_distribution
 import logging
-import networkx as nx
 import sys
 import os
 
@@ -163,7 +162,9 @@ class AbstractApplication(object):
 
         if self.options.create_graph:
             logger.debug("Writing dot file...")
-            nx.write_dot(self.pipeline.G, "labeled-tree.dot")
+            # networkx is only needed to write out the graph
+            import networkx as nx
+            nx.write_dot(self.pipeline.exportGraph(), "labeled-tree.dot")
             logger.debug("Done.")
 
         if not self.options.execute:
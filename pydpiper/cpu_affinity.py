@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import os
+import ctypes
+import ctypes.util
+import logging
+
+"""Pinning the commands of stages to disjoint sets of CPUs.
+
+Multithreaded tools (e.g., ITK-based ones like mincANTS or N4) start as many
+threads as the node has cores unless told otherwise, so an executor running
+several stages at once oversubscribes the node's CPUs.  The executor therefore
+tells the command of each stage how many threads to use (its number of
+processors), and optionally restricts it to that many CPUs of its own, which
+no other stage of the executor runs on.
+
+Python 2 has no os.sched_getaffinity, so we call sched_{get,set}affinity(2)
+in the C library through ctypes; where they're not available (e.g., not on
+Linux), CPUs simply aren't pinned.  Commands are pinned by running them with
+taskset(1) rather than by setting their affinity between fork and exec, which
+isn't safe in the (multithreaded) executor with Python 2's subprocess, or
+after they've started, when they may already have started threads of their
+own."""
+
+logger = logging.getLogger(__name__)
+
+# environment variables telling (OpenMP and ITK) programs how many threads to use
+THREAD_COUNT_VARIABLES = ("OMP_NUM_THREADS", "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS")
+
+# number of CPUs a cpu_set_t can describe (as in glibc)
+CPU_SETSIZE = 1024
+_BITS = 8 * ctypes.sizeof(ctypes.c_ulong)
+
+class cpu_set_t(ctypes.Structure):
+    _fields_ = [("bits", ctypes.c_ulong * (CPU_SETSIZE // _BITS))]
+
+_libc = None
+
+def _getLibc():
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            _libc.sched_getaffinity
+            _libc.sched_setaffinity
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc
+
+def getAffinity(pid=0):
+    """the set of CPUs the process (by default, this one) may run on, or
+    None if that can't be determined"""
+    libc = _getLibc()
+    if not libc:
+        return None
+    mask = cpu_set_t()
+    if libc.sched_getaffinity(pid, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        return None
+    return set(cpu for cpu in range(CPU_SETSIZE)
+               if mask.bits[cpu // _BITS] & (1 << (cpu % _BITS)))
+
+def setAffinity(cpus, pid=0):
+    """restrict the process (by default, this one) to the given CPUs; raises
+    OSError if that fails"""
+    libc = _getLibc()
+    if not libc:
+        raise OSError("sched_setaffinity isn't available")
+    mask = cpu_set_t()
+    for cpu in cpus:
+        mask.bits[cpu // _BITS] |= 1 << (cpu % _BITS)
+    if libc.sched_setaffinity(pid, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+def tasksetPath():
+    """the path of taskset(1), or None if it isn't installed"""
+    for d in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        path = os.path.join(d, "taskset")
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+def pinnedArgv(taskset, cpus, argv):
+    """the command line running argv on the given CPUs only"""
+    return [taskset, "-c", ",".join(str(cpu) for cpu in cpus)] + list(argv)
+
+def threadCountEnv(procs):
+    """the environment variables limiting a command to procs threads"""
+    return dict((v, str(procs)) for v in THREAD_COUNT_VARIABLES)
+
+class CPUAllocator():
+    """Hands out disjoint sets of the CPUs available to the executor."""
+    def __init__(self, cpus):
+        self.free = set(cpus)
+
+    def allocate(self, n):
+        """n free CPUs (the lowest-numbered ones, so that a stage's CPUs tend to
+        be close to each other), or None if there aren't enough"""
+        if n < 1 or n > len(self.free):
+            return None
+        cpus = sorted(self.free)[:n]
+        self.free.difference_update(cpus)
+        return cpus
+
+    def release(self, cpus):
+        if cpus:
+            self.free.update(cpus)
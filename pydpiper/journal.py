@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+import os
+import time
+import zlib
+import logging
+
+"""Append-only journal of finished stages, used to skip them on restart.
+
+Each line has the form "index,digest,checksum" where the checksum is the
+CRC-32 of "index,digest", so that a line torn by a crash (or otherwise
+corrupted) can be recognized and ignored instead of invalidating the whole
+journal.  Lines without a checksum, as written by older versions, are
+accepted as they are.  The stage index is only there for human readers;
+stages are identified by their digest (see PipelineStage.getHash).
+
+Entries are written in groups: they're buffered and only written, flushed
+and fsync'ed once FLUSH_COUNT entries have accumulated or FLUSH_INTERVAL
+seconds have passed (the server also calls maybeFlush periodically).  A
+crash can therefore lose the most recent entries, which only means that
+those stages are run again after a restart."""
+
+FLUSH_COUNT = 64
+FLUSH_INTERVAL = 2.0
+# don't bother compacting journals with fewer stale entries than this
+MIN_STALE_ENTRIES_TO_COMPACT = 1000
+
+logger = logging.getLogger(__name__)
+
+def checksum(entry):
+    return "%08x" % (zlib.crc32(entry) & 0xffffffff)
+
+def formatEntry(index, digest):
+    entry = "%d,%s" % (index, digest)
+    return "%s,%s\n" % (entry, checksum(entry))
+
+def parseEntry(line):
+    """returns the digest recorded on a journal line, or None if the line is corrupt"""
+    fields = line.strip().split(',')
+    if len(fields) == 3:
+        if checksum(fields[0] + "," + fields[1]) != fields[2]:
+            return None
+    elif len(fields) != 2:
+        return None
+    return fields[1] or None
+
+class FinishedStagesJournal():
+    def __init__(self, path, flush_count=FLUSH_COUNT, flush_interval=FLUSH_INTERVAL, fsync=True):
+        self.path = path
+        self.flush_count = flush_count
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fh = None
+        self.buffer = []
+        self.last_flush = time.time()
+        # digests of stages finished in previous runs, so they aren't recorded
+        # again when the server marks them as finished on restart.  Stages
+        # finished in this run are only recorded once anyway (the server
+        # tracks them as finished in its StageStates), so their digests aren't
+        # kept here; and these are dropped by compact, once the server is done
+        # with them
+        self.previous = frozenset()
+        # number of entries in the journal file (including stale/duplicate ones)
+        self.entries = 0
+
+    def read(self):
+        """returns the set of digests of finished stages recorded in the journal
+        (which is empty if there is no journal yet)"""
+        corrupt = 0
+        digests = set()
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    self.entries += 1
+                    digest = parseEntry(line)
+                    if digest is None:
+                        corrupt += 1
+                    else:
+                        digests.add(digest)
+        except IOError:
+            logger.info("Finished stages journal %s doesn't exist yet", self.path)
+        if corrupt:
+            logger.warn("Ignored %d corrupt entries in finished stages journal %s", corrupt, self.path)
+        self.previous = frozenset(digests)
+        return self.previous
+
+    def open(self):
+        if self.fh is None:
+            self.fh = open(self.path, 'a+')
+            # terminate a line torn by a crash so it doesn't swallow the next entry
+            self.fh.seek(0, os.SEEK_END)
+            if self.fh.tell() > 0:
+                self.fh.seek(-1, os.SEEK_END)
+                torn = self.fh.read(1) != "\n"
+                self.fh.seek(0, os.SEEK_END)
+                if torn:
+                    self.fh.write("\n")
+
+    def record(self, index, digest, flush=True):
+        """adds a finished stage to the journal, flushing if enough entries have
+        accumulated or enough time has passed since the last flush (unless
+        flush is False, e.g., because the caller will flush after recording a
+        whole batch of stages).  Stages already in the journal when it was read
+        are ignored; otherwise, it's up to the caller not to record a stage twice"""
+        if digest in self.previous:
+            return
+        self.buffer.append(formatEntry(index, digest))
+        if flush:
+            self.maybeFlush()
+
+    def maybeFlush(self):
+        if self.buffer and (len(self.buffer) >= self.flush_count
+                            or time.time() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+        if not self.buffer:
+            return
+        self.open()
+        self.fh.write("".join(self.buffer))
+        self.fh.flush()
+        if self.fsync:
+            os.fsync(self.fh.fileno())
+        self.entries += len(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+    def compact(self, live):
+        """rewrite the journal to contain only the given (index, digest) pairs,
+        but only if the journal has accumulated a significant number of stale
+        entries (e.g. of stages which are no longer part of the pipeline), so
+        that the history isn't rewritten on every restart.  This is called once
+        the stages finished in previous runs have been skipped, so (either way)
+        their digests are no longer needed"""
+        self.previous = frozenset()
+        stale = self.entries - len(live)
+        if stale < MIN_STALE_ENTRIES_TO_COMPACT or stale < len(live):
+            return False
+        self.close()
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            for index, digest in live:
+                f.write(formatEntry(index, digest))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+        logger.info("Compacted finished stages journal %s (%d stale entries removed)", self.path, stale)
+        self.entries = len(live)
+        return True
@@ -1,19 +1,30 @@
 #!/usr/bin/env python
 
-import networkx as nx
-import Queue
 import os
 import sys
 import signal
 import socket
+import select
+import errno
 import time
 import re
+import bisect
+import heapq
+import hashlib
+import threading
+import Queue
+import cPickle
+from array import array
 from datetime import datetime
-from subprocess import call, check_output
+from subprocess import call, check_output, Popen, PIPE
 from shlex import split
 import multiprocessing
-from multiprocessing import Process, Event
+from multiprocessing import Event
 import file_handling as fh
+from stage_graph import StageGraph
+from journal import FinishedStagesJournal
+from stage_state import StageStates
+from resource_model import StageStatsLog, ResourceModel, inputBytes
 import logging
 
 #TODO move this and Pyro4 imports down into launchServer where pipeline name is available?
@@ -27,12 +38,60 @@ import pipeline_executor as pe
 Pyro4.config.SERVERTYPE = pe.Pyro4.config.SERVERTYPE
 
 LOOP_INTERVAL = 5
+# a failed stage is retried (at most MAX_STAGE_RETRIES times) after a delay of
+# STAGE_RETRY_INTERVAL seconds, doubling with each retry
 STAGE_RETRY_INTERVAL = 1
+MAX_STAGE_RETRIES = 2
+# how long (in s) the server will wait for an executor while waking it up
+WAKE_UP_TIMEOUT = 2.0
+
+# run by the fresh interpreter of an executor launched by the server, which
+# gets the server's sys.path and the arguments for launchPipelineExecutor
+# pickled on its stdin
+LAUNCH_EXECUTOR_CODE = ("import sys, cPickle\n"
+                        "path, options, programName = cPickle.load(sys.stdin)\n"
+                        "sys.path = path\n"
+                        "from pydpiper.pipeline import launchPipelineExecutor\n"
+                        "launchPipelineExecutor(options, programName)\n")
+
+# rough relative cost (runtime) of the stages run by the standard modules,
+# keyed by the program they run (see getProgram); used to weight the critical
+# path when prioritising runnable stages.  Stages can override this using
+# setCost, and anything not listed here gets DEFAULT_STAGE_COST
+STAGE_COST_ESTIMATES = { "mincANTS"                : 60.0,
+                         "rotational_minctracc.py" : 30.0,
+                         "minctracc"               : 10.0,
+                         "nu_estimate"             : 5.0,
+                         "nu_evaluate"             : 2.0,
+                         "inormalize"              : 2.0,
+                         "mincaverage"             : 2.0,
+                         "mincblur"                : 1.0,
+                         "mincresample"            : 1.0,
+                         "autocrop"                : 1.0,
+                         "minc_displacement"       : 1.0,
+                         "lin_from_nlin"           : 0.5,
+                         "xfminvert"               : 0.5,
+                         "xfmconcat"               : 0.5 }
+DEFAULT_STAGE_COST = 1.0
 
 logger = logging.getLogger(__name__)
 
 sys.excepthook = Pyro4.util.excepthook
 
+def stableDigest(*sequences):
+    """returns a hex digest of the given sequences of strings which, unlike the
+    builtin hash, is stable across runs, interpreters and platforms (and
+    practically collision-free), so it can be stored to identify stages across
+    restarts.  Each sequence and string is length-prefixed to keep the encoding
+    unambiguous"""
+    h = hashlib.sha256()
+    for seq in sequences:
+        h.update("%d;" % len(seq))
+        for item in seq:
+            item = str(item)
+            h.update("%d:%s" % (len(item), item))
+    return h.hexdigest()
+
 class PipelineFile():
     def __init__(self, filename):
         self.filename = filename
@@ -68,29 +127,76 @@ class ExecClient():
         self.maxmemory = maxmemory
         self.running_stages = set([])
         self.timestamp = time.time()
-
-class PipelineStage():
+        # the host the executor runs on (the one its daemon listens on)
+        try:
+            self.host = Pyro4.URI(client).host
+        except Exception:
+            self.host = client
+        # (mem, procs) the executor had left after its last request for stages
+        self.free = None
+        # proxy used to wake the executor up when stages it could run become
+        # available (so it needn't poll for them); created on first use, and
+        # only used by the WakeUpNotifier's thread
+        self.proxy = None
+        # is the executor queued to be woken up by the WakeUpNotifier?
+        self.wake_up_pending = False
+
+    def wakeUp(self):
+        # (connecting can take up to WAKE_UP_TIMEOUT, so this is only called
+        # from the WakeUpNotifier's thread, never from the server loop)
+        try:
+            if self.proxy is None:
+                self.proxy = Pyro4.Proxy(self.clientURI)
+                self.proxy._pyroOneway.add("wakeUp")
+                self.proxy._pyroTimeout = WAKE_UP_TIMEOUT
+            self.proxy.wakeUp()
+        except Pyro4.errors.PyroError:
+            # not fatal: the executor will still ask for stages after its wait timeout
+            # (and if it's gone for good, the heartbeat monitoring will notice)
+            logger.debug("Unable to wake up executor %s", self.clientURI)
+            # (so the next wake up connects anew, rather than reusing a broken proxy)
+            self.proxy = None
+
+class WakeUpNotifier():
+    """Wakes up executors from a thread of its own, so that an executor which
+    is slow to connect to (or unreachable) doesn't hold up the server loop."""
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def notify(self, client):
+        # (an executor already waiting to be woken up needn't be queued again)
+        if not client.wake_up_pending:
+            client.wake_up_pending = True
+            self.queue.put(client)
+
+    def run(self):
+        while True:
+            client = self.queue.get()
+            client.wake_up_pending = False
+            client.wakeUp()
+
+class PipelineStage(object):
+    # pipelines can have hundreds of thousands of stages, so don't give each
+    # of them an attribute dictionary (subclasses which don't declare
+    # __slots__ themselves still get one, for their additional attributes)
+    __slots__ = ("mem", "procs", "inputFiles", "outputFiles", "logFile",
+                 "name", "colour", "cost", "env")
     def __init__(self):
         self.mem = 2.0 # default memory allotted per stage
         self.procs = 1 # default number of processors per stage
         self.inputFiles = [] # the input files for this stage
         self.outputFiles = [] # the output files for this stage
         self.logFile = None # each stage should have only one log file
-        self.status = None
         self.name = ""
         self.colour = "black" # used when a graph is created of all stages to colour the nodes
-        self.number_retries = 0 
-
-    def isFinished(self):
-        return self.status == "finished"
-    def setRunning(self):
-        self.status = "running"
-    def setFinished(self):
-        self.status = "finished"
-    def setFailed(self):
-        self.status = "failed"
-    def setNone(self):
-        self.status = None
+        self.cost = None # estimated relative runtime; None means estimate from the name
+        self.env = None # additional environment variables to run the stage with
+
+    # (a stage's status and number of retries are kept by the pipeline it's added to;
+    # see stage_state.py)
     def setMem(self, mem):
         self.mem = mem
     def getMem(self):
@@ -99,27 +205,44 @@ class PipelineStage():
         self.procs = num
     def getProcs(self):
         return self.procs
+    def setEnv(self, env):
+        self.env = env
+    def getEnv(self):
+        return self.env
+    def setCost(self, cost):
+        self.cost = cost
+    def getProgram(self):
+        """the program the stage runs (stage names often include parameters or
+        the name of the subject, so they don't identify the kind of stage)"""
+        words = self.name.split()
+        return os.path.basename(words[0]) if words else ""
+    def getCost(self):
+        if self.cost is not None:
+            return self.cost
+        return STAGE_COST_ESTIMATES.get(self.getProgram(), DEFAULT_STAGE_COST)
     def getHash(self):
+        return stableDigest(self.outputFiles, self.inputFiles)
+    def getLegacyHash(self):
+        # identity used before getHash was stable; only used to recognize
+        # stages in finished-stages logs written by older versions
         return(hash("".join(self.outputFiles) + "".join(self.inputFiles)))
     def __eq__(self, other):
         return self.inputFiles == other.inputFiles and self.outputFiles == other.outputFiles
     def __ne__(self, other):
         return not(__eq__(self,other))
-    def getNumberOfRetries(self):
-        return self.number_retries
-    def incrementNumberOfRetries(self):
-        self.number_retries += 1
 
 class CmdStage(PipelineStage):
+    __slots__ = ("cmd",)
     def __init__(self, argArray):
         PipelineStage.__init__(self)
-        self.argArray = argArray # the raw input array
         self.cmd = [] # the input array converted to strings
-        self.parseArgs()
+        # (the raw input array isn't kept: everything we need from it ends up in
+        # cmd, inputFiles and outputFiles)
+        self.parseArgs(argArray)
         self.checkLogFile()
-    def parseArgs(self):
-        if self.argArray:
-            for a in self.argArray:
+    def parseArgs(self, argArray):
+        if argArray:
+            for a in argArray:
                 ft = getattr(a, "fileType", None)
                 if ft == "input":
                     self.inputFiles.append(str(a))
@@ -127,6 +250,10 @@ class CmdStage(PipelineStage):
                     self.outputFiles.append(str(a))
                 self.cmd.append(str(a))
                 self.name = self.cmd[0]
+    def getProgram(self):
+        if self.cmd:
+            return os.path.basename(self.cmd[0])
+        return PipelineStage.getProgram(self)
     def checkLogFile(self):
         if not self.logFile:
             self.logFile = self.name + "." + datetime.isoformat(datetime.now()) + ".log"
@@ -148,10 +275,189 @@ class CmdStage(PipelineStage):
         return(returncode)
     
     def getHash(self):
+        # the log file isn't part of what the stage computes, so changing
+        # it (e.g., to a new timestamped default) shouldn't re-run the stage
+        return stableDigest([a for a in self.cmd if a != self.logFile])
+    def getLegacyHash(self):
         return(hash(" ".join(self.cmd)))
     def __repr__(self):
         return(" ".join(self.cmd))
 
+class StageBuckets():
+    """
+    Stages indexed by their resource requirements: stages with identical
+    (mem, procs) requirements share a bucket, and the keys of the non-empty
+    buckets are kept sorted so that the buckets which fit into an executor's
+    free resources can be found by bisection rather than by only looking at
+    the head of a FIFO queue.  Each bucket is a heap of (-priority, sequence
+    number, stage index) entries, i.e., ordered by stage priority (higher
+    first) and then by the order in which stages became runnable.
+
+    Entries are removed lazily: an entry for which live(entry) is false is
+    dropped once it reaches the head of its bucket.
+    """
+    def __init__(self):
+        # (mem, procs) -> heap of (-priority, sequence number, stage index)
+        self.buckets = {}
+        # sorted list of the (mem, procs) keys of all non-empty buckets
+        self.keys = []
+
+    def push(self, key, entry):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = []
+            bisect.insort(self.keys, key)
+        heapq.heappush(bucket, entry)
+
+    def head(self, key, live):
+        """the first live entry of a bucket (or None, after removing the
+        bucket, if it has none left)"""
+        bucket = self.buckets[key]
+        while bucket and not live(bucket[0]):
+            heapq.heappop(bucket)
+        if not bucket:
+            del self.buckets[key]
+            del self.keys[bisect.bisect_left(self.keys, key)]
+            return None
+        return bucket[0]
+
+    def best(self, live):
+        """the key of the bucket with the highest-priority (then longest-waiting)
+        live entry, regardless of its requirements"""
+        best = bestHead = None
+        for key in self.keys[:]:
+            head = self.head(key, live)
+            if head is not None and (bestHead is None or head < bestHead):
+                best, bestHead = key, head
+        return best
+
+    def best_fitting(self, memFree, procsFree, live):
+        """the key of the bucket with the highest-priority live entry that fits
+        into memFree/procsFree, preferring larger stages among those of equal
+        priority (or None if nothing fits)"""
+        best = bestHead = None
+        j = bisect.bisect_right(self.keys, (memFree, float('inf')))
+        while j > 0:
+            j -= 1
+            key = self.keys[j]
+            if key[1] <= procsFree:
+                # (this may remove keys[j], which doesn't affect keys[:j])
+                head = self.head(key, live)
+                if head is not None and (bestHead is None or head[0] < bestHead[0]):
+                    best, bestHead = key, head
+        return best
+
+    def pop(self, key):
+        bucket = self.buckets[key]
+        entry = heapq.heappop(bucket)
+        if not bucket:
+            del self.buckets[key]
+            del self.keys[bisect.bisect_left(self.keys, key)]
+        return entry
+
+class RunnablePool():
+    """
+    The stages that are ready to run, indexed by their mem/procs requirements
+    (see StageBuckets).
+
+    A stage can also be given the host on which (most of) its inputs were
+    produced, in which case it's indexed by the stages preferring that host
+    as well.  get_fitting then prefers the stages whose inputs are local to
+    the executor asking for them, so large intermediate files are only read
+    from another node when the alternative is to leave the executor idle.
+    Once a stage is taken from the pool, its entries in the other indices
+    become stale (their sequence number no longer matches) and are dropped lazily.
+    """
+    def __init__(self):
+        self.all = StageBuckets()
+        # host -> StageBuckets of the stages preferring that host
+        self.local = {}
+        # stage index -> (mem, procs) for every stage currently in the pool
+        self.members = {}
+        # stage index -> sequence number of its entries
+        self.entries = {}
+        self.seq = 0
+
+    def qsize(self):
+        return len(self.members)
+
+    def empty(self):
+        return len(self.members) == 0
+
+    def __contains__(self, i):
+        return i in self.members
+
+    def live(self, entry):
+        return self.entries.get(entry[2]) == entry[1]
+
+    def put(self, i, mem, procs, priority=0, host=None, seq=None):
+        """add stage i (preferring to run on host, if given); returns False if
+        it was already in the pool.  A stage re-added to a new pool can keep
+        its place in the queue by passing the sequence number it had"""
+        if i in self.members:
+            return False
+        if seq is None:
+            seq = self.seq
+            self.seq += 1
+        key = (mem, procs)
+        entry = (-priority, seq, i)
+        self.all.push(key, entry)
+        if host is not None:
+            self.local.setdefault(host, StageBuckets()).push(key, entry)
+        self.members[i] = key
+        self.entries[i] = seq
+        return True
+
+    def take(self, buckets, key):
+        _, _, i = buckets.pop(key)
+        del self.members[i]
+        del self.entries[i]
+        return i
+
+    def get(self):
+        """remove and return the highest-priority (then longest-waiting) stage
+        regardless of its requirements (or None if the pool is empty)"""
+        key = self.all.best(self.live)
+        if key is None:
+            return None
+        return self.take(self.all, key)
+
+    def get_fitting(self, memFree, procsFree, host=None):
+        """remove and return the highest-priority stage that fits into
+        memFree/procsFree, preferring stages which prefer the given host and
+        then larger stages among those of equal priority (or None if nothing fits)"""
+        local = self.local.get(host)
+        if local is not None:
+            key = local.best_fitting(memFree, procsFree, self.live)
+            if key is not None:
+                return self.take(local, key)
+            if not local.keys:
+                del self.local[host]
+        key = self.all.best_fitting(memFree, procsFree, self.live)
+        if key is None:
+            return None
+        return self.take(self.all, key)
+
+    def forgetHost(self, host):
+        """stop indexing stages by whether they prefer host (e.g., since it has
+        no executors anymore)"""
+        self.local.pop(host, None)
+
+    def fits(self, memFree, procsFree):
+        """is there a stage in the pool which fits into memFree/procsFree?"""
+        return self.all.best_fitting(memFree, procsFree, self.live) is not None
+
+    def min_mem(self):
+        """the smallest amount of memory any runnable stage requires"""
+        while self.all.keys:
+            key = self.all.keys[0]
+            if self.all.head(key, self.live) is not None:
+                return key[0]
+        return None
+
+    def mem_requirements(self):
+        return [mem for mem, _ in self.members.itervalues()]
+
 class Pipeline():
     # TODO the way we initialize a pipeline is currently a bit gross, e.g.,
     # setting a bunch of instance variables after __init__ - the presence of a method
@@ -159,24 +465,30 @@ class Pipeline():
     # there is indeed some information legitimately unavailable when we first construct
     def __init__(self):
         # the core pipeline is stored in a directed graph. The graph is made
-        # up of integer indices
-        self.G = nx.DiGraph()
+        # up of integer indices (see stage_graph.py)
+        self.G = StageGraph()
         # an array of the actual stages (PipelineStage objects)
         self.stages = []
         self.nameArray = []
-        # a queue of the stages ready to be run - contains indices
-        self.runnable = Queue.Queue()
-        # an array to keep track of stage memory requirements
-        self.mem_req_for_runnable = []
-        self.currently_running_stages = set([])
+        # the scheduling state (status, retries, mem, procs, processed) of each stage
+        self.state = StageStates()
+        # the stages ready to be run, indexed by their mem/procs requirements
+        self.runnable = RunnablePool()
         # the current stage counter
         self.counter = 0
         # hash to keep the output to stage association
         self.outputhash = {}
+        # per stage: estimated cost of the longest path to a sink of the graph
+        # (computed once in initialize, used to order runnable stages)
+        self.priorities = []
+        # per stage: number of predecessors which haven't finished yet; a stage
+        # becomes runnable when this reaches 0 (computed in computeGraphHeads)
+        self.unfinished_predecessors = array('i')
         # a hash per stage - computed from inputs and outputs or whole command
         self.stagehash = {}
-        # an array containing the status per stage
-        self.processedStages = []
+        # one string object per distinct command line argument/path, shared by
+        # all the stages mentioning it (see internStage)
+        self.paths = {}
         # location of backup files for restart if needed
         self.backupFileLocation = None
         # table of registered clients (using ExecClient class instances) indexed by URI
@@ -186,6 +498,9 @@ class Pipeline():
         # are actually registered, a whole bunch of them could be waiting in the
         # queue
         self.number_launched_and_waiting_clients = 0
+        # processes of the executors launched by the server (kept so they can
+        # be reaped once they've exited)
+        self.executor_processes = []
         # clients we've lost contact with due to crash, etc.
         self.failed_executors = 0
         # main option hash, needed for the pipeline (server) to launch additional
@@ -197,10 +512,44 @@ class Pipeline():
         self.shutdown_ev = Event()
         self.programName = None
         self.skipped_stages = 0
-        self.failed_stages = 0
         self.verbose = 0
-        # Handle to write out processed stages to
-        self.finished_stages_fh = None
+        # journal of finished stages (used to skip them on restart)
+        self.journal = None
+        # failed stages waiting to be retried: a heap of (time due, index)
+        self.retry_heap = []
+        self.max_stage_retries = MAX_STAGE_RETRIES
+        self.stage_retry_interval = STAGE_RETRY_INTERVAL
+        # clients which have been told to wait despite having free resources,
+        # and which should be woken up when stages they can run become runnable
+        self.waiting_clients = set()
+        # wakes them up (created on first use)
+        self.wake_up_notifier = None
+        # have stages become runnable since we last woke up waiting clients?
+        self.runnable_changed = False
+        # hosts of the executors which finished stages, numbered in order of
+        # appearance, and per stage: the number of the host it ran on (or -1)
+        self.host_ids = {}
+        self.produced_on = array('h')
+        # (number of the) host -> number of registered executors on it; stages
+        # only prefer hosts which have some
+        self.clients_per_host = {}
+        # observed resource usage of the stages, and (optionally) the model
+        # learned from the observations of previous runs used to set their memory
+        self.stage_stats = None
+        self.resource_model = None
+        # per stage: the memory the model predicted it needs (or -1 if it hasn't
+        # been predicted yet), so its input files are only stat'ed once
+        self.predicted_mem = array('d')
+        # identifies the records of this run among those of earlier runs (the
+        # statistics file accumulates over restarts)
+        self.run_id = time.time()
+        # per stage: when it (last) became runnable, and for the stages handed
+        # out and not yet reported: how long they waited to be handed out
+        self.runnable_since = array('d')
+        self.queue_waits = {}
+        # per stage: the next stage of the fused chain it belongs to, or -1
+        # (None unless fuseStageChains has been called)
+        self.chain_next = None
 
     # expose methods to get/set shutdown_ev via Pyro (setter not needed):
     def set_shutdown_ev(self):
@@ -212,13 +561,16 @@ class Pipeline():
         return self.failed_executors
 
     def getNumberFailedStages(self):
-        return self.failed_stages
+        return self.state.count("failed")
 
     def getTotalNumberOfStages(self):
         return len(self.stages)
     
     def getNumberProcessedStages(self):
-        return len(self.processedStages)
+        return self.state.number_processed
+
+    def getStageStatus(self, i):
+        return self.state.getStatus(i)
 
     def getNumberOfRunningClients(self):
         return len(self.clients)
@@ -230,13 +582,13 @@ class Pipeline():
         self.verbose = verbosity
 
     def getCurrentlyRunningStages(self):
-        return self.currently_running_stages
+        return sorted([i for c in self.clients.itervalues() for i in c.running_stages])
 
     def getNumberRunnableStages(self):
         return self.runnable.qsize()
 
     def getMemoryRequirementsRunnable(self):
-        return self.mem_req_for_runnable
+        return self.runnable.mem_requirements()
 
     def getMemoryAvailableInClients(self):
         return [c.maxmemory for _, c in self.clients.iteritems()]
@@ -254,15 +606,32 @@ class Pipeline():
         else: #stage doesn't exist - add it
             self.stagehash[h] = self.counter
             #self.statusArray[self.counter] = 'notstarted'
+            self.internStage(stage)
             self.stages.append(stage)
+            self.state.add(stage.mem, stage.procs)
             self.nameArray.append(stage.name)
             # add all outputs to the output dictionary
             for o in stage.outputFiles:
                 self.outputhash[o] = self.counter
             # add the stage's index to the graph
-            self.G.add_node(self.counter, label=stage.name,color=stage.colour)
+            self.G.add_node()
             self.counter += 1
 
+    def internPath(self, path):
+        return self.paths.setdefault(path, path)
+
+    def internStage(self, stage):
+        """replaces the strings in the stage's command, input and output files
+        by the equal ones already used by other stages of this pipeline; the
+        same (long, absolute) paths show up in many stages and several times
+        per stage, so this way each is only stored once"""
+        stage.inputFiles = [self.internPath(f) for f in stage.inputFiles]
+        stage.outputFiles = [self.internPath(f) for f in stage.outputFiles]
+        stage.name = self.internPath(stage.name)
+        cmd = getattr(stage, "cmd", None)
+        if cmd:
+            stage.cmd = [self.internPath(a) for a in cmd]
+
     def setBackupFileLocation(self, outputDir=None):
         """Sets location of backup files."""
         if outputDir is None:
@@ -273,6 +642,10 @@ class Pipeline():
         self.backupFileLocation = os.path.join(outputDir,
                                     self.main_options_hash.pipeline_name
                                      + '_finished_stages')
+        self.journal = FinishedStagesJournal(self.backupFileLocation)
+        self.stage_stats = StageStatsLog(os.path.join(outputDir,
+                                         self.main_options_hash.pipeline_name
+                                         + '_stage_stats'))
     def addPipeline(self, p):
         if p.skipped_stages > 0:
             self.skipped_stages += p.skipped_stages
@@ -288,51 +661,131 @@ class Pipeline():
         print "Total number of stages in the pipeline: ", len(self.stages)
                    
     def printNumberProcessedStages(self):
-        print "Number of stages already processed:     ", len(self.processedStages)
+        print "Number of stages already processed:     ", self.state.number_processed
                    
     def createEdges(self):
         """computes stage dependencies by examining their inputs/outputs"""
         starttime = time.time()
+        sources = array('i')
+        targets = array('i')
         # iterate over all nodes
         for i in self.G.nodes_iter():
-            for ip in self.stages[i].inputFiles:
-                # if the input to the current stage was the output of another
-                # stage, add a directional dependence to the DiGraph
-                if self.outputhash.has_key(ip):
-                    self.G.add_edge(self.outputhash[ip], i)
+            # if the input to the current stage was the output of another
+            # stage, add a directional dependence to the graph (only once
+            # per producing stage, and never from a stage to itself)
+            producers = set([self.outputhash[ip] for ip in self.stages[i].inputFiles
+                             if ip in self.outputhash])
+            producers.discard(i)
+            for j in producers:
+                sources.append(j)
+                targets.append(i)
+        # the edges are added in bulk, which builds the compact adjacency arrays
+        self.G.set_edges(sources, targets)
         endtime = time.time()
         logger.info("Create Edges time: " + str(endtime-starttime))
     def computeGraphHeads(self):
-        """adds stages with no incomplete predecessors to the runnable queue"""
+        """counts the unfinished predecessors of every stage and adds stages
+        with none (and which aren't finished themselves) to the runnable queue"""
+        self.unfinished_predecessors = array('i', [0]) * len(self.stages)
         graphHeads = []
         for i in self.G.nodes_iter():
-            if self.stages[i].isFinished() == False:
-                """ either it has 0 predecessors """
-                if len(self.G.predecessors(i)) == 0:
-                    self.runnable.put(i)
-                    # keep track of the memory requirements of the runnable jobs
-                    self.mem_req_for_runnable.append(self.stages[i].mem)
-                    graphHeads.append(i)
-                """ or all of its predecessors are finished """
-                if len(self.G.predecessors(i)) != 0:
-                    predfinished = True
-                    for j in self.G.predecessors(i):
-                        if self.stages[j].isFinished() == False:
-                            predfinished = False
-                    if predfinished == True:
-                        self.runnable.put(i) 
-                        # keep track of the memory requirements of the runnable jobs
-                        self.mem_req_for_runnable.append(self.stages[i].mem)
-                        graphHeads.append(i)
+            n = 0
+            for j in self.G.predecessors_iter(i):
+                if not self.state.isFinished(j):
+                    n += 1
+            self.unfinished_predecessors[i] = n
+            if n == 0 and not self.state.isFinished(i):
+                self.addRunnableStage(i)
+                graphHeads.append(i)
         logger.info("Graph heads: " + str(graphHeads))
+    def exportGraph(self):
+        """returns the stage graph as a networkx.DiGraph with node labels and
+        colours (e.g., to write a .dot file for --create-graph)"""
+        return self.G.to_networkx(labels=[s.name for s in self.stages],
+                                  colours=[s.colour for s in self.stages])
     def getStage(self, i):
         """given an index, return the actual pipelineStage object"""
         return(self.stages[i])
     # getStage<...> are currently used instead of getStage due to previous bug; could revert:
     def getStageMem(self, i):
-        return(self.stages[i].mem)
+        return(self.state.mem[i])
     def getStageProcs(self,i):
-        return(self.stages[i].procs)
+        return(self.state.procs[i])
+    def getChain(self, i):
+        """stage i followed by the rest of its fused chain (if any) which still
+        has to be run"""
+        chain = [i]
+        if self.chain_next is not None:
+            j = self.chain_next[i]
+            while (j != -1 and self.state.getStatus(j) is None
+                   and not self.state.isProcessed(j)):
+                chain.append(j)
+                j = self.chain_next[j]
+        return chain
+
+    def fuseStageChains(self):
+        """Fuse chains of stages in which each stage is the only input of the
+        next one and the next one the only consumer of its outputs, so each
+        chain is handed out as a single unit (saving a round trip through the
+        scheduler per link).  A stage's mem/procs requirements are raised to
+        the maximum over the rest of its chain, since it's run together with
+        it.  Called (optionally) once the pipeline has been initialized."""
+        n = len(self.stages)
+        self.chain_next = array('i', [-1]) * n
+        fused = 0
+        for i in xrange(n):
+            if self.G.out_degree(i) == 1:
+                j = next(self.G.successors_iter(i))
+                if self.G.in_degree(j) == 1:
+                    self.chain_next[i] = j
+                    fused += 1
+        # propagate requirements backwards along the chains (in reverse
+        # topological order, so each stage sees its successor's final value)
+        for i in reversed(self.G.topological_order()):
+            j = self.chain_next[i]
+            if j != -1:
+                self.state.mem[i] = max(self.state.mem[i], self.state.mem[j])
+                self.state.procs[i] = max(self.state.procs[i], self.state.procs[j])
+        self.rebuildRunnablePool()
+        logger.info("Fused %d links of stage chains", fused)
+
+    def rebuildRunnablePool(self):
+        """re-index the runnable stages (e.g., after changing their requirements);
+        they keep their place in the queue and the time they became runnable"""
+        old = self.runnable
+        self.runnable = RunnablePool()
+        self.runnable.seq = old.seq
+        for i, seq in old.entries.iteritems():
+            self.setPredictedMem(i)
+            priority = self.priorities[i] if self.priorities else 0
+            self.runnable.put(i, self.state.mem[i], self.state.procs[i], priority,
+                              host = self.preferredHost(i), seq = seq)
+        self.runnable_changed = True
+
+    def releaseChainRemainder(self, index, clientURI):
+        """the rest of the chain handed out with stage index won't be run
+        (e.g., since the stage failed), so it's no longer running on the client"""
+        if self.chain_next is None:
+            return
+        client = self.clients.get(clientURI)
+        j = self.chain_next[index]
+        while j != -1 and client is not None and j in client.running_stages:
+            self.removeFromRunning(j, clientURI, new_status = None)
+            j = self.chain_next[j]
+
+    def getStageDescriptor(self, i):
+        """everything an executor needs to know to run stage i, so it
+        needn't ask the server for the details one by one"""
+        command = repr(self.stages[i])
+        return { "index"   : i,
+                 "command" : command,
+                 "argv"    : split(command),
+                 "logfile" : self.stages[i].logFile,
+                 "mem"     : self.state.mem[i],
+                 "procs"   : self.state.procs[i],
+                 "env"     : self.stages[i].env or {},
+                 "inputs"  : self.stages[i].inputFiles,
+                 "outputs" : self.stages[i].outputFiles }
     def getStageCommand(self,i):
         return(repr(self.stages[i]))
     def getStageLogfile(self,i):
@@ -345,27 +798,87 @@ class Pipeline():
         # so this is sort of OK)
 
     """Given client information, issue commands to the client (along similar
-    lines to getRunnableStageIndex) and update server's internal view of client.
-    This is highly stateful, being a resource-tracking wrapper around
-    getRunnableStageIndex and hence a glorified Queue().get()."""
-    def getCommand(self, clientURIstr, clientMemFree, clientProcsFree):
+    lines to getRunnableStageIndex): hand out as many runnable stages as fit
+    into the client's free memory and processors in a single round trip,
+    largest first, so that a single big stage doesn't leave executors idle
+    while smaller stages could run.  Returns a tuple of a command and a list
+    of units to run (empty unless the command is "run_stage"), each of which
+    is a dict of the index of the stage handed out, the mem and procs it needs,
+    and the descriptors (see getStageDescriptor) of the steps to run one after
+    the other: the stage itself and, if it's part of a fused chain, the rest of
+    the chain.  All of them are marked as started on the client right away."""
+    def getCommands(self, clientURIstr, clientMemFree, clientProcsFree):
         if self.is_time_to_drain():
-            return ("shutdown_abnormally", None)
-
-        flag, i = self.getRunnableStageIndex()
-        if flag == "run_stage":
-            if ((self.getStageMem(i) <= clientMemFree) and (self.getStageProcs(i) <= clientProcsFree)):
-                return (flag, i)
-            else:
-                if self.getStageMem(i) > clientMemFree:
-                    logger.debug("The executor does not have enough free memory (free: %.2fG, required: %.2fG) to run stage %d. (Executor: %s)", clientMemFree, self.getStageMem(i), i, clientURIstr)
-                if self.getStageProcs(i) > clientProcsFree:
-                    logger.debug("The executor does not have enough free processors (free: %.1f, required: %.1f) to run stage %d. (Executor: %s)", clientProcsFree, self.getStageProcs(i), i, clientURIstr)
-                self.requeue(i)
-                # TODO search the queue for something this client can run?
-                return ("wait", None)
+            return ("shutdown_abnormally", [])
+
+        if self.allStagesCompleted():
+            return ("shutdown_normally", [])
+
+        client = self.clients.get(clientURIstr)
+        if client is None:
+            # (e.g., an executor we've considered dead and unregistered: anything
+            # we handed out to it would be lost)
+            logger.warn("Executor %s asked for stages but isn't registered", clientURIstr)
+            return ("wait", [])
+        self.releaseDelayedRetries()
+        host = self.host_ids.get(client.host)
+        stages = []
+        now = time.time()
+        while True:
+            i = self.runnable.get_fitting(clientMemFree, clientProcsFree, host)
+            if i is None:
+                break
+            if i < len(self.runnable_since):
+                self.queue_waits[i] = now - self.runnable_since[i]
+            steps = self.getChain(i)
+            for j in steps:
+                self.setStageStarted(j, clientURIstr)
+            # (a stage's requirements already cover the rest of its chain)
+            stage = { "index" : i,
+                      "mem"   : self.state.mem[i],
+                      "procs" : self.state.procs[i],
+                      "steps" : [self.getStageDescriptor(j) for j in steps] }
+            clientMemFree   -= stage["mem"]
+            clientProcsFree -= stage["procs"]
+            stages.append(stage)
+        self.noteFreeResources(clientURIstr, clientMemFree, clientProcsFree)
+        if len(stages) == 0:
+            if not self.runnable.empty():
+                logger.debug("None of the %d runnable stages fit into the executor's free resources (free: %.2fG, %.1f procs; executor: %s)",
+                             self.runnable.qsize(), clientMemFree, clientProcsFree, clientURIstr)
+            return ("wait", [])
+        logger.debug("Handing out %d stages to executor %s", len(stages), clientURIstr)
+        return ("run_stage", stages)
+
+    def noteFreeResources(self, clientURI, memFree, procsFree):
+        """remember which clients could run more stages than we've given them"""
+        client = self.clients.get(clientURI)
+        if client is None:
+            return
+        if memFree > 0 and procsFree > 0:
+            client.free = (memFree, procsFree)
+            self.waiting_clients.add(clientURI)
         else:
-            return (flag, i)
+            self.waiting_clients.discard(clientURI)
+
+    def wakeWaitingClients(self):
+        """tell waiting clients with enough free resources for one of the
+        newly runnable stages to ask for stages right away (rather than after
+        their wait timeout); called from the server loop between requests"""
+        if not self.runnable_changed:
+            return
+        self.runnable_changed = False
+        for clientURI in list(self.waiting_clients):
+            if self.runnable.empty():
+                break
+            client = self.clients.get(clientURI)
+            if client is None:
+                self.waiting_clients.discard(clientURI)
+            elif self.runnable.fits(*client.free):
+                self.waiting_clients.discard(clientURI)
+                if self.wake_up_notifier is None:
+                    self.wake_up_notifier = WakeUpNotifier()
+                self.wake_up_notifier.notify(client)
 
     """Return a tuple of a command ("shutdown_normally" if all stages are finished,
     "wait" if no stages are currently runnable, or "run_stage" if a stage is
@@ -378,16 +891,10 @@ class Pipeline():
             return ("wait", None)
         else:
             index = self.runnable.get()
-            # remove an instance of currently required memory
-            try:
-                self.mem_req_for_runnable.remove(self.stages[index].mem)
-            except:
-                logger.debug("mem_req_for_runnable: %s; mem: %s", self.mem_req_for_runnable, self.stages[index].mem)
-                logger.exception("It wasn't here!")
             return ("run_stage", index)
 
     def allStagesCompleted(self):
-        return len(self.processedStages) == len(self.stages)
+        return self.state.number_processed == len(self.stages)
 
     def addRunningStageToClient(self, clientURI, index):
         try:
@@ -417,58 +924,145 @@ class Pipeline():
         # It would be better to catch that earlier (by using a different/additional data structure)
         # but for now look for the case when a stage is run twice at the same time, which may
         # produce bizarre results as both processes write files
-        if self.stages[index].status == 'running':
+        if self.state.isRunning(index):
             raise Exception('stage %d is already running' % index)
         self.addRunningStageToClient(clientURI, index)
-        self.currently_running_stages.add(index)
-        self.stages[index].setRunning()
+        self.state.setStatus(index, "running")
 
     def checkIfRunnable(self, index):
         """stage added to runnable queue if all predecessors finished"""
-        canRun = True
-        logger.debug("Checking if stage " + str(index) + " is runnable ...")
-        if self.stages[index].isFinished():
-            canRun = False
-        else:
-            for i in self.G.predecessors(index):              
-                s = self.getStage(i)
-                if not s.isFinished():
-                    canRun = False
-                    break
+        canRun = self.unfinished_predecessors[index] == 0 and not self.state.isFinished(index)
         logger.debug("Stage " + str(index) + " Runnable: " + str(canRun))
         return canRun
 
-    def setStageFinished(self, index, clientURI, save_state = True, checking_pipeline_status = False):
+    def setStageFinished(self, index, clientURI, save_state = True, checking_pipeline_status = False, flush_journal = True,
+                         journal = True):
         """given an index, sets corresponding stage to finished and adds successors to the runnable queue"""
         # this function can be called when a pipeline is restarted, and 
         # we go through all stages and set the finished ones to... finished... :-)
         # in that case, we can not remove the stage from the list of running
         # jobs, because there is none.
+        if self.state.isFinished(index):
+            # e.g., a stage requeued after its executor was presumed dead which
+            # then finishes twice; its successors have already been released
+            logger.warn("Stage %d was already finished; ignoring", index)
+            if clientURI in self.clients:
+                self.clients[clientURI].running_stages.discard(index)
+            return
         if checking_pipeline_status:
             logger.debug("Already finished stage " + str(index))
-            self.stages[index].status = "finished"
+            self.state.setStatus(index, "finished")
         else:
             logger.info("Finished Stage " + str(index) + ": " + str(self.stages[index]))
             self.removeFromRunning(index, clientURI, new_status = "finished")
-        self.processedStages.append(index)
-        # write out the (index, hash) pairs to disk.  We don't actually need the indices
+        self.state.setProcessed(index)
+        # remember where the stage's outputs were written, so its successors
+        # can be run on the same host (see RunnablePool)
+        client = self.clients.get(clientURI)
+        if client is not None and index < len(self.produced_on):
+            self.produced_on[index] = self.getHostID(client.host)
+        # journal the (index, hash) pairs.  We don't actually need the indices
         # for anything (in fact, the restart code in skip_completed_stages is resilient 
         # against an arbitrary renumbering of stages), but a human-readable log is somewhat useful.
-        self.finished_stages_fh.write("%d,%s\n" % (index, self.stages[index].getHash()))
-        self.finished_stages_fh.flush()
-        for i in self.G.successors(index):
+        # (the journal ignores stages it already contains, e.g., when restarting;
+        # and stages whose outputs an executor kept in scratch space for the rest
+        # of their fused chain aren't journaled, since their outputs don't exist)
+        if self.journal is not None and journal:
+            self.journal.record(index, self.stages[index].getHash(), flush = flush_journal)
+        # successors become runnable once their last unfinished predecessor
+        # finishes (failed or lost stages never decrement these counters)
+        for i in self.G.successors_iter(index):
+            self.unfinished_predecessors[i] -= 1
             if self.checkIfRunnable(i):
-                self.runnable.put(i)
-                # keep track of the memory requirements of the runnable jobs
-                self.mem_req_for_runnable.append(self.stages[i].mem)
+                self.addRunnableStage(i)
 
-    def removeFromRunning(self, index, clientURI, new_status):
+    def setStagesTerminated(self, clientURI, results):
+        """given a list of (index, return code, statistics) triples of stages which
+        terminated on a client, set the successful ones to finished and the others
+        to failed.  Executors report their stages in batches this way so a burst of
+        stages finishing doesn't turn into a burst of requests (and journal writes)"""
         try:
-            self.currently_running_stages.discard(index)
-        except:
-            logger.exception("Unable to remove stage %d from client %s's stages: %s", index, clientURI, self.clients[clientURI].running_stages)
+            for index, returncode, stats in results:
+                # (the executor has already forgotten about these stages, so an
+                # error with one of them mustn't keep the rest from being updated)
+                try:
+                    self.recordStageStats(index, returncode, stats, clientURI)
+                    if returncode == 0:
+                        self.setStageFinished(index, clientURI, flush_journal = False,
+                                              journal = not (stats and stats.get("outputs_kept_local")))
+                    else:
+                        # a None returncode is also considered a failure
+                        self.setStageFailed(index, clientURI)
+                except Exception:
+                    logger.exception("Unable to update stage %s reported by %s (return code %s)",
+                                     index, clientURI, returncode)
+        finally:
+            if self.journal is not None:
+                self.journal.maybeFlush()
+
+    def recordStageStats(self, index, returncode, stats, clientURI=None):
+        """save the resource usage the executor measured for a stage, along with
+        how long it waited to be handed out (if it was the head of its unit), the
+        executor which ran it and its predecessors (so that pipeline_report.py
+        can reconstruct the timeline and critical path of the run)"""
+        queue_wait = self.queue_waits.pop(index, None)
+        if self.stage_stats is None or not stats:
+            return
+        record = dict(stats)
+        record.update({ "index"        : index,
+                        "queue_wait"   : queue_wait,
+                        "executor"     : clientURI,
+                        "predecessors" : list(self.G.predecessors_iter(index)),
+                        "name"         : self.stages[index].name,
+                        "program"      : self.stages[index].getProgram(),
+                        "run"          : self.run_id,
+                        "returncode"   : returncode,
+                        "mem"          : self.state.mem[index],
+                        "procs"        : self.state.procs[index] })
+        self.stage_stats.record(record)
+
+    def learnStageMemory(self, margin):
+        """set the memory requirements of runnable stages (and those becoming
+        runnable later) from the stage statistics of previous runs"""
+        self.setResourceModel(ResourceModel(self.stage_stats.read(), margin))
+
+    def setResourceModel(self, model):
+        self.resource_model = model
+        self.predicted_mem = array('d', [-1.0]) * len(self.stages)
+        self.rebuildRunnablePool()
+
+    def setPredictedMem(self, i):
+        # (only once the stage is runnable, since that's when its inputs exist)
+        if self.resource_model is None:
+            return
+        stage = self.stages[i]
+        mem = self.predicted_mem[i]
+        if mem < 0:
+            input_bytes = inputBytes(stage.inputFiles)
+            mem = self.predictStageMem(i, input_bytes)
+            # the stage's requirements also cover the rest of its fused chain (if
+            # any), whose inputs don't all exist yet: assume they're about as
+            # large as the stage's own
+            for j in self.getChain(i)[1:]:
+                mem = max(mem, self.predictStageMem(j, max(input_bytes, inputBytes(self.stages[j].inputFiles))))
+            self.predicted_mem[i] = mem
+        # a stage no executor has enough memory for would end the pipeline (see
+        # continueLoop), so rather have it try with all the memory there is
+        # (but don't ask for less than it would have without the model)
+        memAvailable = self.getMemoryAvailableInClients()
+        if memAvailable and mem > max(memAvailable):
+            mem = max(max(memAvailable), stage.mem)
+        if mem != self.state.mem[i]:
+            logger.debug("Setting memory of stage %d to %.2fG (default: %.2fG)", i, mem, stage.mem)
+            self.state.mem[i] = mem
+
+    def predictStageMem(self, i, input_bytes):
+        stage = self.stages[i]
+        return self.resource_model.predictMem(stage.getProgram(), input_bytes, stage.mem)
+
+    def removeFromRunning(self, index, clientURI, new_status):
         self.removeRunningStageFromClient(clientURI, index)
-        self.stages[index].status = new_status
+        self.state.setStatus(index, new_status)
 
     def setStageLost(self, index, clientURI):
         """Clean up a stage lost due to unresponsive client"""
@@ -478,23 +1072,25 @@ class Pipeline():
 
     def setStageFailed(self, index, clientURI):
         # given an index, sets stage to failed, adds to processed stages array
-        # But... only if this stage has already been retried twice (<- for now static)
+        # But... only if this stage has already been retried max_stage_retries times.
         # Once in while retrying a stage makes sense, because of some odd I/O
         # read write issue (NFS race condition?). At least that's what I think is 
         # happening, so trying this to see whether it solves the issue.
-        num_retries = self.stages[index].getNumberOfRetries()
-        if num_retries < 2:
-            # without a sleep statement, the stage will be retried within 
-            # a handful of milliseconds, that won't solve anything...
-            # this sleep command will block the server for a small amount 
-            # of time, but should happen only sporadically
-            time.sleep(STAGE_RETRY_INTERVAL)
+        num_retries = self.state.retries[index]
+        self.releaseChainRemainder(index, clientURI)
+        if num_retries < self.max_stage_retries:
+            # retrying within a handful of milliseconds won't solve anything, so
+            # the stage only becomes runnable again after a delay (doubling with
+            # each retry).  We mustn't sleep here since that would block the
+            # server for everyone, so the stage is put on a heap of delayed
+            # retries which releaseDelayedRetries requeues once they're due
+            delay = self.stage_retry_interval * 2 ** num_retries
             self.removeFromRunning(index, clientURI, new_status = None)
-            self.stages[index].incrementNumberOfRetries()
+            self.state.incrementRetries(index)
             logger.info("RETRYING: ERROR in Stage " + str(index) + ": " + str(self.stages[index]))
-            logger.info("RETRYING: adding this stage back to the runnable queue.")
+            logger.info("RETRYING: adding this stage back to the runnable queue in %.1f s.", delay)
             logger.info("RETRYING: Logfile for Stage " + str(self.stages[index].logFile))
-            self.requeue(index)
+            heapq.heappush(self.retry_heap, (time.time() + delay, index))
         else:
             self.removeFromRunning(index, clientURI, new_status = "failed")
             logger.info("ERROR in Stage " + str(index) + ": " + str(self.stages[index]))
@@ -502,23 +1098,85 @@ class Pipeline():
             print("\nERROR in Stage %s: %s" % (str(index), str(self.stages[index])))
             print("Logfile for (potentially) more information:\n%s\n" % self.stages[index].logFile)
             sys.stdout.flush()
-            self.processedStages.append(index)
-            self.failed_stages += 1
-            for i in nx.dfs_successor(self.G, index).keys():
-                self.processedStages.append(i)
+            self.state.setProcessed(index)
+            # nothing depending on this stage can run anymore (setProcessed
+            # ignores stages already given up on due to another failure)
+            for i in self.G.descendants(index):
+                self.state.setProcessed(i)
+
+    def releaseDelayedRetries(self):
+        """requeue the failed stages whose retry delay has passed"""
+        now = time.time()
+        while self.retry_heap and self.retry_heap[0][0] <= now:
+            _, i = heapq.heappop(self.retry_heap)
+            self.requeue(i)
+
+    def addRunnableStage(self, i):
+        """add stage i to the pool of runnable stages (indexed by its mem/procs requirements)"""
+        if self.state.isRunning(i):
+            # a later stage of a fused chain which is still being run
+            return
+        if i in self.runnable:
+            logger.debug("Stage %d is already runnable", i)
+            return
+        self.setPredictedMem(i)
+        if i < len(self.runnable_since):
+            self.runnable_since[i] = time.time()
+        priority = self.priorities[i] if self.priorities else 0
+        self.runnable.put(i, self.state.mem[i], self.state.procs[i], priority,
+                          host = self.preferredHost(i))
+        self.runnable_changed = True
+
+    def getHostID(self, host):
+        return self.host_ids.setdefault(host, len(self.host_ids))
+
+    def preferredHost(self, i):
+        """the (number of the) host on which most of stage i's input files were
+        produced, or None if they weren't produced by stages of this run"""
+        counts = {}
+        for f in self.stages[i].inputFiles:
+            j = self.outputhash.get(f)
+            if j is not None and j < len(self.produced_on) and self.produced_on[j] != -1:
+                h = self.produced_on[j]
+                counts[h] = counts.get(h, 0) + 1
+        # (stages preferring hosts without executors would never be handed out
+        # as local ones, so they needn't be indexed by host)
+        for h in counts.keys():
+            if h not in self.clients_per_host:
+                del counts[h]
+        if not counts:
+            return None
+        return max(counts, key=counts.get)
 
     def requeue(self, i):
-        """If stage cannot be run due to insufficient mem/procs, executor returns it to the queue"""
+        """Return a stage (e.g., one lost with its executor or being retried) to the runnable pool"""
         logger.debug("Requeueing stage %d", i)
-        self.runnable.put(i)
-        # keep track of the memory requirements of the runnable jobs
-        self.mem_req_for_runnable.append(self.stages[i].mem)
+        # (a stage lost along with the earlier stages of its fused chain
+        # becomes runnable again once they've been run)
+        if self.unfinished_predecessors[i] == 0:
+            self.addRunnableStage(i)
 
     def initialize(self):
         """called once all stages have been added - computes dependencies and adds graph heads to runnable queue"""
-        self.runnable = Queue.Queue()
+        self.runnable = RunnablePool()
+        self.produced_on = array('h', [-1]) * len(self.stages)
+        self.runnable_since = array('d', [0.0]) * len(self.stages)
         self.createEdges()
+        self.computePriorities()
         self.computeGraphHeads()
+
+    def computePriorities(self):
+        """computes each stage's priority as the estimated cost of the longest
+        path from the stage to any sink of the graph (including the stage itself),
+        so that stages gating long chains of work are dispatched first"""
+        starttime = time.time()
+        self.priorities = [0.0] * len(self.stages)
+        for i in reversed(self.G.topological_order()):
+            self.priorities[i] = self.stages[i].getCost() + max([self.priorities[j] for j in self.G.successors_iter(i)] or [0.0])
+        endtime = time.time()
+        logger.info("Compute priorities time: " + str(endtime-starttime))
+        if self.priorities:
+            logger.info("Estimated critical path cost: %.1f", max(self.priorities))
         
     """
         Returns True unless all stages are finished, then False
@@ -536,11 +1194,15 @@ class Pipeline():
             logger.debug("Shutdown event is set ... quitting")
             return False
 
+        self.releaseDelayedRetries()
+
         # exit if there are still stages that need to be run, 
         # but when there are no runnable nor any running stages left
+        # (nor any waiting to be retried)
         if (self.runnable.empty() and
-            len(self.currently_running_stages) == 0
-            and self.failed_stages > 0):
+            self.state.count("running") == 0 and
+            len(self.retry_heap) == 0
+            and self.state.count("failed") > 0):
             # nothing running, nothing can be run, but we're
             # also not done processing all stages
             logger.info("ERROR: no more runnable stages, however not all stages have finished. Going to shut down.")
@@ -554,7 +1216,7 @@ class Pipeline():
         # currently we should exit (potentially later on, we can submit
         # executors that have enough memory available)
         if self.runnable.qsize() > 0 and len(self.clients) > 0:
-            minMemRequired = min(self.mem_req_for_runnable)
+            minMemRequired = self.runnable.min_mem()
             memAvailable = self.getMemoryAvailableInClients()
             if max(memAvailable) < minMemRequired:
                 print "\n\nError: the maximum amount of memory available in any executor is %f. The minimum amount of memory required to run any of the runnable stages is: %f. Quitting...\n\n" % (max(memAvailable),minMemRequired)
@@ -589,6 +1251,10 @@ class Pipeline():
     # this can't be a loop since we call it via sockets and don't want to block the socket forever
     def manageExecutors(self):
         logger.debug("Looping ...")
+        if self.journal is not None:
+            self.journal.maybeFlush()
+        if self.stage_stats is not None:
+            self.stage_stats.flush()
         executors_to_launch = self.numberOfExecutorsToLaunch()
         if executors_to_launch > 0:
             self.launchExecutorsFromServer(executors_to_launch)
@@ -641,17 +1307,26 @@ class Pipeline():
             return 0
         
     def launchExecutorsFromServer(self, number_to_launch):
+        # the executors are started in fresh interpreters rather than forked
+        # (as with multiprocessing.Process): the server has threads of its own
+        # (e.g., the WakeUpNotifier's), and a forked child could inherit a lock
+        # (logging's, say) held by one of them at the time, never to be released
+        self.executor_processes = [p for p in self.executor_processes if p.poll() is None]
         try:
             logger.info("Launching %i executors", number_to_launch)
+            args = cPickle.dumps((sys.path, self.main_options_hash, self.programName),
+                                 cPickle.HIGHEST_PROTOCOL)
             for i in range(number_to_launch):
-                p = Process(target=launchPipelineExecutor, args=(self.main_options_hash,self.programName))
-                p.start()
+                p = Popen([sys.executable, "-c", LAUNCH_EXECUTOR_CODE], stdin=PIPE)
+                p.stdin.write(args)
+                p.stdin.close()
+                self.executor_processes.append(p)
                 self.incrementLaunchedClients()
         except:
             logger.exception("Failed launching executors from the server.")
         
     def getProcessedStageCount(self):
-        return len(self.processedStages)
+        return self.state.number_processed
 
     def registerClient(self, clientURI, maxmemory):
         # Adds new client (represented by a URI string)
@@ -659,7 +1334,15 @@ class Pipeline():
         # its own clients, we should remove 1 from the number of launched and waiting
         # clients (It's possible though that users launch clients themselves. In that 
         # case we should not decrease this variable)
-        self.clients[clientURI] = ExecClient(clientURI, maxmemory)
+        memAvailable = self.getMemoryAvailableInClients()
+        client = ExecClient(clientURI, maxmemory)
+        if clientURI not in self.clients:
+            host = self.getHostID(client.host)
+            self.clients_per_host[host] = self.clients_per_host.get(host, 0) + 1
+        self.clients[clientURI] = client
+        # the memory predicted for stages is limited by what executors have
+        if self.resource_model is not None and (not memAvailable or maxmemory > max(memAvailable)):
+            self.rebuildRunnablePool()
         if self.number_launched_and_waiting_clients > 0:
             self.number_launched_and_waiting_clients -= 1
         logger.debug("Client registered (banzai): %s", clientURI)
@@ -674,7 +1357,14 @@ class Pipeline():
         try:
             for s in self.clients[clientURI].running_stages.copy():
                 self.setStageLost(s, clientURI)
-            del self.clients[clientURI]
+            client = self.clients.pop(clientURI)
+            self.waiting_clients.discard(clientURI)
+            host = self.getHostID(client.host)
+            self.clients_per_host[host] -= 1
+            if self.clients_per_host[host] == 0:
+                # nobody will ask for the stages preferring the host anymore
+                del self.clients_per_host[host]
+                self.runnable.forgetHost(host)
         except:
             if self.verbose:
                 print("Unable to un-register client: " + clientURI)
@@ -688,18 +1378,14 @@ class Pipeline():
         self.number_launched_and_waiting_clients += 1
 
     def skip_completed_stages(self):
-        try:
-            with open(self.backupFileLocation, 'r') as fh:
-                # a stage's index is just an artifact of the graph construction,
-                # so load only the hashes of finished stages
-                previous_hashes = frozenset((int(e.split(',')[1]) for e in fh.read().split()))
-        except:
-            logger.info("Finished stages log doesn't exist or is corrupt.")
+        # a stage's index is just an artifact of the graph construction,
+        # so the journal only gives us the hashes of finished stages
+        previous_hashes = self.journal.read()
+        if not previous_hashes:
+            logger.info("No previously finished stages found.")
             return
-        # processedStages was read from finished_stages_fh, so:
-        self.finished_stages_fh = open(self.backupFileLocation, 'w')
         runnable  = []
-        completed = 0
+        completed = []
         while True:
             # self.runnable should be populated initially by the graph heads.
             # Traverse the graph by removing stages from the runnable queue and,
@@ -718,20 +1404,27 @@ class Pipeline():
                 runnable.append(i)
                 continue
 
-            # we've never run this command before
-            if not s.getHash() in previous_hashes:
+            # we've never run this command before (logs written by older versions
+            # contain the legacy hashes, which we still recognize so that upgrading
+            # doesn't re-run everything)
+            if not (s.getHash() in previous_hashes
+                    or str(s.getLegacyHash()) in previous_hashes):
                 runnable.append(i)
                 continue
 
+            # (this doesn't re-write the stage to the journal, unless
+            # it was only recognized by its legacy hash)
             self.setStageFinished(i, clientURI = "fake_client_URI", checking_pipeline_status = True)
-            completed += 1
+            completed.append(i)
 
         logger.debug("Runnable: %s", runnable)
         for i in runnable:
             self.requeue(i)
 
-        self.finished_stages_fh.close()
-        logger.info('Previously completed stages (of %d total): %d', len(self.stages), completed)
+        # drop entries of stages that are no longer part of the pipeline if there are many
+        self.journal.flush()
+        self.journal.compact([(i, self.stages[i].getHash()) for i in completed])
+        logger.info('Previously completed stages (of %d total): %d', len(self.stages), len(completed))
 
     def printShutdownMessage(self):
         # it is possible that pipeline.continueLoop returns false, even though the
@@ -794,67 +1487,36 @@ def launchServer(pipeline, options):
     
     pipeline.setVerbosity(options.verbose)
 
+    # handle SIGTERM (sent by SciNet 15-30s before hard kill) by setting
+    # the shutdown event (we shouldn't actually see a SIGTERM on PBS
+    # since PBS submission logic gives us a lifetime related to our walltime
+    # request ...)
+    def handler(sig,_stack):
+        #logger.info("Caught signal %s", sig) # this probably isn't safe!!
+        pipeline.shutdown_ev.set()
+    signal.signal(signal.SIGTERM, handler)
+
     try:
-        # start Pyro server
-        t = Process(target=daemon.requestLoop)
-        #t.daemon = True # this isn't allowed
-        t.start()
-
-        # at this point requests made to the Pyro daemon will touch process `t`'s copy
-        # of the pipeline, so modifiying `pipeline` won't have any effect.  The exception is
-        # communication through its multiprocessing.Event, which we use below to wait
-        # for termination.
-
-        verboseprint("Daemon is running at: %s" % daemon.locationStr)
-        logger.info("Daemon is running at: %s", daemon.locationStr)
-        verboseprint("The pipeline's uri is: %s" % str(pipelineURI))
-        logger.info("The pipeline's uri is: %s", str(pipelineURI))
-
-        # handle SIGTERM (sent by SciNet 15-30s before hard kill) by setting
-        # the shutdown event (we shouldn't actually see a SIGTERM on PBS
-        # since PBS submission logic gives us a lifetime related to our walltime
-        # request ...)
-        def handler(sig,_stack):
-            #logger.info("Caught signal %s", sig) # this probably isn't safe!!
-            pipeline.shutdown_ev.set()
-        signal.signal(signal.SIGTERM, handler)
-
-        # spawn a loop to manage executors in a separate process
-        # (here we use a proxy to make calls to manageExecutors because (a) 
-        # processes don't share memory, (b) so that its logic is
-        # not interleaved with calls from executors.  We could instead use a `select`
-        # for both Pyro and non-Pyro socket events; see the Pyro documentation)
-        p = Pyro4.Proxy(pipelineURI)
-        def loop():
-            try:
-                logger.debug("Auxiliary loop started")
-                while p.continueLoop():
-                    p.manageExecutors()
-                    pipeline.shutdown_ev.wait(LOOP_INTERVAL)
-            except:
-                logger.exception("Server loop encountered a problem.  Shutting down.")
-            finally:
-                logger.info("Server loop going to shut down ...")
-                p.set_shutdown_ev()
+        jid    = os.environ["PBS_JOBID"]
+        output = check_output(['qstat', '-f', jid])
 
-        h = Process(target=loop)
-        h.daemon = True
-        h.start()
+        time_left = int(re.search('Walltime.Remaining = (\d*)', output).group(1))
+        logger.debug("Time remaining: %d s" % time_left)
+        time_to_live = time_left - pe.SHUTDOWN_TIME
+    except:
+        logger.info("I couldn't determine your remaining walltime from qstat.")
+        time_to_live = None
 
-        try:
-            jid    = os.environ["PBS_JOBID"]
-            output = check_output(['qstat', '-f', jid])
+    verboseprint("Daemon is running at: %s" % daemon.locationStr)
+    logger.info("Daemon is running at: %s", daemon.locationStr)
+    verboseprint("The pipeline's uri is: %s" % str(pipelineURI))
+    logger.info("The pipeline's uri is: %s", str(pipelineURI))
 
-            time_left = int(re.search('Walltime.Remaining = (\d*)', output).group(1))
-            logger.debug("Time remaining: %d s" % time_left)
-            time_to_live = time_left - pe.SHUTDOWN_TIME
-        except:
-            logger.info("I couldn't determine your remaining walltime from qstat.")
-            time_to_live = None
-        flag = pipeline.shutdown_ev.wait(time_to_live)
-        if not flag:
-            logger.info("Time's up!")
-        pipeline.shutdown_ev.set()
+    try:
+        serverLoop(daemon, pipeline, time_to_live)
+        # clients which contact the server after it's gone will notice
+        # and cancel their (by then finished) jobs
+        pipeline.printShutdownMessage()
 
     # FIXME if we terminate abnormally, we should _actually_ kill child executors (if running locally)
     except KeyboardInterrupt:
@@ -862,26 +1524,63 @@ def launchServer(pipeline, options):
         print("\nKeyboardInterrupt caught: cleaning up, shutting down executors.\n")
         sys.stdout.flush()
     except:
-        logger.exception("Exception running server in daemon.requestLoop. Server shutting down.")
+        logger.exception("Exception running server in serverLoop. Server shutting down.")
         print("%s" % sys.exc_info())
-    else:
-        # allow time for all clients to contact the server and be told to shut down
-        # (we could instead add a way for the server to notify its registered clients):
-        # otherwise they will crash when they try to contact the (shutdown) server.
-        # It's not important that clients shut down properly (if they see a server crash, they
-        # will cancel their running jobs, but they're done by the time the server exits)
-        # TODO this only makes sense if we are actually shutting down nicely,
-        # and not because we're out of walltime, in which case this doesn't help
-        # (client jobs will die anyway)
-        #print("Sleeping %d s to allow time for clients to shutdown..." % pe.SHUTDOWN_TIME)
-        #time.sleep(pe.SHUTDOWN_TIME)
-        # trying to access variables from `p` in the `finally` clause (in order
-        # to print a shutdown message) hangs for some reason, so do it here instead
-        p.printShutdownMessage()
     finally:
-        # brutal, but awkward to do with our system of `Event`s
-        # could send a signal to `t` instead:
-        t.terminate()
+        pipeline.shutdown_ev.set()
+        daemon.close()
+
+def serverLoop(daemon, pipeline, time_to_live=None):
+    """
+    The server's event loop: a single loop in the server process owns the
+    pipeline, handling requests from executors as their sockets become readable
+    (Pyro's multiplex daemon lets us do the select ourselves) and running the
+    housekeeping (continueLoop/manageExecutors) on a timer in between requests,
+    so that neither has to go through the daemon or compete with the other
+    for it.  Returns when the pipeline is done (or has failed), when the
+    shutdown event is set, or when time_to_live seconds have passed.
+    """
+    deadline = time.time() + time_to_live if time_to_live is not None else None
+    next_housekeeping = time.time()
+    while not pipeline.shutdown_ev.is_set():
+        now = time.time()
+        if deadline is not None and now >= deadline:
+            logger.info("Time's up!")
+            break
+        if now >= next_housekeeping:
+            try:
+                if not pipeline.continueLoop():
+                    break
+                pipeline.manageExecutors()
+            except:
+                logger.exception("Server loop encountered a problem.  Shutting down.")
+                break
+            next_housekeeping = now + LOOP_INTERVAL
+        # finished stages are buffered by the journal; make sure they're written
+        # even when no further requests come in to trigger a flush
+        if pipeline.journal is not None:
+            pipeline.journal.maybeFlush()
+        timeout = next_housekeeping - now
+        if deadline is not None:
+            timeout = min(timeout, deadline - now)
+        if pipeline.journal is not None and pipeline.journal.buffer:
+            timeout = min(timeout, pipeline.journal.flush_interval)
+        if pipeline.retry_heap:
+            timeout = min(timeout, pipeline.retry_heap[0][0] - now)
+        try:
+            ready, _, _ = select.select(daemon.sockets, [], [], max(timeout, 0))
+        except select.error as e:
+            # interrupted by a signal (e.g., SIGTERM, which sets shutdown_ev)
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        if ready:
+            daemon.events(ready)
+        # push newly runnable stages (including failed ones now due for a retry)
+        # by waking up executors which can run them
+        pipeline.releaseDelayedRetries()
+        pipeline.wakeWaitingClients()
+    logger.info("Server loop going to shut down ...")
 
 def flatten_pipeline(p):
     """return a list of tuples for each stage.
@@ -914,7 +1613,7 @@ def pipelineDaemon(pipeline, options, programName=None):
         sys.exit()
     
     logger.debug("Prior to starting server, total stages %i. Number processed: %i.", 
-                 len(pipeline.stages), len(pipeline.processedStages))
+                 len(pipeline.stages), pipeline.state.number_processed)
     logger.debug("Number of stages in runnable queue: %i",
                  pipeline.runnable.qsize())
     
@@ -923,12 +1622,20 @@ def pipelineDaemon(pipeline, options, programName=None):
     # # during run time
     #pipeline.main_options_hash = options
     pipeline.programName = programName
-    # we are now appending to the stages file since we've already written
-    # previously completed stages to it in skip_completed_stages
+    pipeline.max_stage_retries = options.max_stage_retries
+    pipeline.stage_retry_interval = options.stage_retry_interval
+    if options.fuse_stage_chains:
+        pipeline.fuseStageChains()
+    if options.learn_stage_memory:
+        pipeline.learnStageMemory(options.memory_safety_margin)
+    # we are appending to the journal of finished stages (which may already contain
+    # previously completed stages), starting with anything skip_completed_stages buffered
+    pipeline.journal.open()
+    pipeline.journal.flush()
     try:
-        with open(pipeline.backupFileLocation, 'a') as fh: #TODO exception swallowed here if fh can't be created??
-            pipeline.finished_stages_fh = fh
-            logger.debug("Starting server...")
-            launchServer(pipeline, options)
+        logger.debug("Starting server...")
+        launchServer(pipeline, options)
     finally:
+        pipeline.journal.close()
+        pipeline.stage_stats.close()
         sys.exit(0)
@@ -5,25 +5,54 @@ import sys
 import os
 from configargparse import ArgParser
 from datetime import datetime
-from multiprocessing import Process, Pool
+from multiprocessing import Process
 import subprocess as subprocess
-from shlex import split
 import pydpiper.queueing as q
+import pydpiper.resource_model as rm
+import pydpiper.cpu_affinity as ca
+import pydpiper.staging as staging
 import atoms_and_modules.registration_functions as rf
 import logging
 import socket
 import signal
+import select
+import errno
+import fcntl
 import threading
 import Pyro4
 import re
+import tempfile
 
 Pyro4.config.SERVERTYPE = "multiplex"
+# the messages exchanged by the server and its executors only contain basic
+# types (stage descriptors are dicts of strings and numbers), so use the
+# marshal serializer, which is several times faster than the default one
+# for these small messages, if this version of Pyro has it
+try:
+    Pyro4.util.get_serializer("marshal")
+except Exception:
+    pass
+else:
+    Pyro4.config.SERIALIZER = "marshal"
+    Pyro4.config.SERIALIZERS_ACCEPTED.add("marshal")
 
 WAIT_TIMEOUT = 5.0
 HEARTBEAT_INTERVAL = 10.0
 LATENCY_TOLERANCE = 15.0
 # q.SERVER_START_TIME
 SHUTDOWN_TIME = WAIT_TIMEOUT + LATENCY_TOLERANCE
+# stages terminating within COMPLETION_REPORT_WINDOW seconds of each other
+# (up to COMPLETION_REPORT_SIZE of them) are reported to the server together
+COMPLETION_REPORT_WINDOW = 0.05
+COMPLETION_REPORT_SIZE = 50
+# with --measured-memory-admission, units which started less than this many
+# seconds ago (so may not have reached their peak yet) count as using at least
+# their declared memory
+MEMORY_WARMUP = 60.0
+# with --suspend-on-memory-pressure, at least this many seconds pass between
+# suspending or resuming one unit and suspending or resuming another, so the
+# memory use measured reflects the last action before we take the next one
+MEMORY_PRESSURE_INTERVAL = 10.0
 
 logger = logging.getLogger(__name__)
 
@@ -44,6 +73,45 @@ def addExecutorArgumentGroup(parser):
     group.add_argument("--max-failed-executors", dest="max_failed_executors",
                       type=int, default=2,
                       help="Maximum number of failed executors before we stop relaunching. [Default = %(default)s]")
+    group.add_argument("--max-stage-retries", dest="max_stage_retries",
+                      type=int, default=2,
+                      help="Maximum number of times a failed stage is retried before it (and everything depending on it) is considered failed. [Default = %(default)s]")
+    group.add_argument("--stage-retry-interval", dest="stage_retry_interval",
+                      type=float, default=1.0,
+                      help="Number of seconds to wait before retrying a failed stage; this doubles with each subsequent retry of the same stage. [Default = %(default)s]")
+    group.add_argument("--learn-stage-memory", dest="learn_stage_memory",
+                      action="store_true", default=False,
+                      help="Set the memory requirements of stages from the peak memory used by the same programs (on inputs of similar size) in previous runs of the pipeline, rather than from the defaults. [Default = %(default)s]")
+    group.add_argument("--memory-safety-margin", dest="memory_safety_margin",
+                      type=float, default=0.2,
+                      help="Fraction of additional memory to request for stages beyond the learned requirements. [Default = %(default)s]")
+    group.add_argument("--fuse-stage-chains", dest="fuse_stage_chains",
+                      action="store_true", default=False,
+                      help="Run chains of stages in which each stage only feeds into the next one as single units on one executor. [Default = %(default)s]")
+    group.add_argument("--measured-memory-admission", dest="measured_memory_admission",
+                      action="store_true", default=False,
+                      help="Take on more stages as long as the memory the executor's stages actually use (rather than the memory they declare) leaves --memory-headroom free, and stop taking on stages when it doesn't. [Default = %(default)s]")
+    group.add_argument("--memory-headroom", dest="memory_headroom",
+                      type=float, default=0.1,
+                      help="With --measured-memory-admission, the fraction of --mem to keep free. [Default = %(default)s]")
+    group.add_argument("--suspend-on-memory-pressure", dest="suspend_on_memory_pressure",
+                      action="store_true", default=False,
+                      help="With --measured-memory-admission, suspend the most recently started stage while the executor's stages use more than --mem (and resume it once there's room again). [Default = %(default)s]")
+    group.add_argument("--scratch-dir", dest="scratch_dir",
+                      type=str, default=None,
+                      help="Node-local directory (e.g., $TMPDIR or /dev/shm) in which stages write their outputs, which are moved to their final locations once the stage has succeeded, rather than writing them to the shared filesystem directly. [Default = %(default)s]")
+    group.add_argument("--keep-chain-intermediates-local", dest="keep_chain_intermediates_local",
+                      action="store_true", default=False,
+                      help="With --scratch-dir and --fuse-stage-chains, don't publish outputs of stages in a fused chain which are only used by the rest of the chain, unless the chain fails. Since their outputs don't exist, such stages aren't recorded as finished, so a restarted pipeline reruns their chains. [Default = %(default)s]")
+    group.add_argument("--input-cache-dir", dest="input_cache_dir",
+                      type=str, default=None,
+                      help="Node-local directory (e.g., $TMPDIR) in which to keep copies of input files read by several stages run by the executor, so they're read from the shared filesystem less often. [Default = %(default)s]")
+    group.add_argument("--input-cache-size", dest="input_cache_size",
+                      type=float, default=10,
+                      help="Amount of disk space (in GB) each executor may use for its input cache. [Default = %(default)s]")
+    group.add_argument("--pin-stage-cpus", dest="pin_stage_cpus",
+                      action="store_true", default=False,
+                      help="Restrict the commands of the stages an executor runs at the same time to disjoint sets of CPUs (of as many CPUs as the stages need processors), so they don't compete for cores. Only use this if executors don't share nodes. [Default = %(default)s]")
     # TODO add corresponding --monitor-heartbeats
     group.add_argument("--no-monitor-heartbeats", dest="monitor_heartbeats",
                       action="store_false",
@@ -97,6 +165,10 @@ def noExecSpecified(numExec):
 def launchExecutor(executor):
     # Start executor that will run pipeline stages
 
+    # (before registering with the server, so that we don't take stages
+    # only to fail all of them)
+    executor.checkScratchDir()
+
     # getIpAddress is similar to socket.gethostbyname(...) 
     # but uses a hack to attempt to avoid returning localhost (127....)
     network_address = Pyro4.socketutil.getIpAddress(socket.gethostname(),
@@ -136,7 +208,8 @@ def launchExecutor(executor):
     executor.connection_time_with_server = time.time()
     logger.info("Connected to the server at: %s", datetime.isoformat(datetime.now(), " "))
     
-    executor.initializePool()
+    executor.initializeChildReaping()
+    executor.initializeInputCache()
     
     logger.debug("Executor daemon running at: %s", daemon.locationStr)
     try:
@@ -149,6 +222,7 @@ def launchExecutor(executor):
         h = threading.Thread(target=executor.heartbeat)
         h.daemon = True
         h.start()
+        executor.startReporting()
         executor.mainLoop()
     except KeyboardInterrupt:
         logger.exception("Caught keyboard interrupt. Shutting down executor...")
@@ -166,48 +240,39 @@ def launchExecutor(executor):
         daemon.shutdown()
         t.join()
 
-def runStage(serverURI, clientURI, i):
-    ## Proc needs its own proxy as it's independent of executor
-    p = Pyro4.core.Proxy(serverURI)
-    client = Pyro4.core.Proxy(clientURI)
-    
-    # Retrieve stage information, run stage and set finished or failed accordingly  
-    try:
-        logger.info("Running stage %i (on %s)", i, clientURI)
-        p.setStageStarted(i, clientURI)
+class WakeupPipe():
+    """An Event-like object (set/wait/clear) on which the executor's main loop
+    waits.  Other threads set it by writing to a pipe, and so do signals (via
+    signal.set_wakeup_fd), in particular SIGCHLD, which tells us that the
+    command of a stage has exited."""
+    def __init__(self):
+        self.r, self.w = os.pipe()
+        for fd in (self.r, self.w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            # (the commands we run shouldn't inherit the pipe)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+    def set(self):
         try:
-            # get stage information
-            command_to_run  = str(p.getStageCommand(i))
-            logger.info(command_to_run)
-            command_logfile = p.getStageLogfile(i)
-            
-            # log file for the stage
-            of = open(command_logfile, 'a')
-            of.write("Stage " + str(i) + " running on " + socket.gethostname() + " at " + datetime.isoformat(datetime.now(), " ") + ":\n")
-            of.write(command_to_run + "\n")
-            of.flush()
-            
-            args = split(command_to_run) 
-            process = subprocess.Popen(args, stdout=of, stderr=of, shell=False)
-            client.addPIDtoRunningList(process.pid)
-            process.communicate()
-            client.removePIDfromRunningList(process.pid)
-            ret = process.returncode 
-            of.close()
-        except:
-            logger.exception("Exception whilst running stage: %i (on %s)", i, clientURI)   
-            client.notifyStageTerminated(i)
-        else:
-            logger.info("Stage %i finished, return was: %i (on %s)", i, ret, clientURI)
-            client.notifyStageTerminated(i, ret)
-
-        # If completed, return mem & processes back for re-use
-        return (p.getStageMem(i), p.getStageProcs(i))
-    except:
-        logger.exception("Error communicating to server in runStage. " 
-                        "Error raised to calling thread in launchExecutor. ")
-        raise     
-        
+            os.write(self.w, "x")
+        except OSError:
+            # the pipe is full, so we'll wake up anyway
+            pass
+
+    def wait(self, timeout=None):
+        try:
+            select.select([self.r], [], [], timeout)
+        except select.error as e:
+            # interrupted by a signal, which has written to the pipe itself
+            if e.args[0] != errno.EINTR:
+                raise
+
+    def clear(self):
+        try:
+            while os.read(self.r, 4096):
+                pass
+        except OSError:
+            pass
 
         """
         This class is used for the actual commands that are run by the 
@@ -215,11 +280,191 @@ def runStage(serverURI, clientURI, i):
         initiated by the executor
         """
 class ChildProcess():
-    def __init__(self, stage, result, mem, procs):
-        self.stage = stage
-        self.result = result
-        self.mem = mem
-        self.procs = procs 
+    # a unit handed out by the server (a stage, or a stage and the rest of its
+    # fused chain) being run by the executor: its steps are run one after the
+    # other, each as a child process of the executor, stopping at the first
+    # one that fails; the unit's mem and procs are in use until it's done
+    def __init__(self, unit, scratch_dir=None, keep_intermediates_local=False, input_cache=None):
+        self.stage = unit["index"]
+        self.mem = unit["mem"]
+        self.procs = unit["procs"]
+        self.steps = list(unit["steps"])
+        # the CPUs the unit's commands are pinned to (None if they aren't),
+        # and the taskset(1) they're run with to pin them
+        self.cpus = None
+        self.taskset = None
+        # when the unit was started, and whether we've suspended it (with SIGSTOP)
+        self.started = time.time()
+        self.suspended = False
+        # the current step, the Popen object of its command, and the
+        # statistics about its resource usage gathered so far
+        self.index = None
+        self.process = None
+        self.stats = None
+        # (index, return code, statistics) of steps not yet reported to the server
+        self.results = []
+        # with a scratch directory: the staged outputs of the current step,
+        # those of earlier steps kept in scratch space for the rest of the unit,
+        # and the paths in scratch space of the outputs kept there
+        self.scratch_dir = scratch_dir
+        self.keep_intermediates_local = keep_intermediates_local
+        self.staged = None
+        self.local = []
+        self.local_paths = {}
+        # the cache of input files (if any), and the inputs of the current
+        # step whose cached copies it's using
+        self.input_cache = input_cache
+        self.cached_inputs = []
+
+    def startNextStep(self):
+        """start the command of the next step in the background; raises an
+        exception (after which self.index and self.stats describe the step)
+        if it can't be started"""
+        stage = self.steps.pop(0)
+        i = self.index = stage["index"]
+        self.process = None
+        self.suspended = False
+        self.stats = { "input_bytes" : rm.inputBytes(stage["inputs"]),
+                       "host"        : socket.gethostname() }
+        logger.info("Running stage %i", i)
+        logger.info(stage["command"])
+
+        argv = stage["argv"]
+        if self.scratch_dir is not None:
+            # write the outputs to scratch space, and read inputs kept there
+            # by earlier steps from there
+            self.staged = staging.StagedOutputs(self.scratch_dir, i, argv, stage["outputs"])
+            argv = [self.staged.paths.get(a, self.local_paths.get(a, a)) for a in argv]
+        if self.input_cache is not None:
+            argv = list(argv)
+            inputs = set(stage["inputs"])
+            cached = []
+            for k, a in enumerate(argv):
+                if a in inputs:
+                    path = self.input_cache.get(a)
+                    if path != a:
+                        argv[k] = path
+                        cached.append(a)
+            # (only the copies we got are released when the step is done)
+            self.cached_inputs = cached
+            self.stats["cached_inputs"] = len(cached)
+
+        # log file for the stage
+        of = open(stage["logfile"], 'a')
+        try:
+            of.write("Stage " + str(i) + " running on " + socket.gethostname() + " at " + datetime.isoformat(datetime.now(), " ") + ":\n")
+            of.write(stage["command"] + "\n")
+            if argv != stage["argv"]:
+                of.write("(run as: " + " ".join(argv) + ")\n")
+            of.flush()
+
+            # tell multithreaded programs to use as many threads as the stage
+            # has processors, rather than one per core of the node (unless
+            # the stage itself says otherwise)
+            env = os.environ.copy()
+            env.update(ca.threadCountEnv(stage["procs"]))
+            env.update(stage["env"] or {})
+            if self.cpus is not None:
+                argv = ca.pinnedArgv(self.taskset, self.cpus, argv)
+            self.stats["start"] = time.time()
+            self.process = subprocess.Popen(argv, stdout=of, stderr=of, shell=False, env=env)
+        finally:
+            # (the command has its own copy of the file descriptor)
+            of.close()
+
+    def poll(self):
+        """if the command of the current step has exited, reap it and return the
+        return code of the step and its statistics (the start and wall time,
+        user and system CPU time in s, peak memory in G, the total size of its
+        input files and its I/O counters in bytes); otherwise return None"""
+        pid = self.process.pid
+        # the I/O counters of the command disappear once it's reaped, so read
+        # them while it's a zombie (if there is no /proc, we just do without)
+        state = rm.processState(pid)
+        if state == 'Z':
+            self.stats.update(rm.processIO(pid))
+        elif state is not None:
+            return None
+        # (rather than process.poll(), to get the command's resource usage)
+        reaped, status, usage = os.wait4(pid, os.WNOHANG)
+        if reaped == 0:
+            return None
+        self.stats["walltime"] = time.time() - self.stats["start"]
+        self.stats["utime"] = usage.ru_utime
+        self.stats["stime"] = usage.ru_stime
+        self.stats["maxrss"] = usage.ru_maxrss / 1024.0 ** 2  # ru_maxrss is in kB
+        if os.WIFSIGNALED(status):
+            ret = -os.WTERMSIG(status)
+        else:
+            ret = os.WEXITSTATUS(status)
+        # (so the Popen object doesn't try to reap the command itself)
+        self.process.returncode = ret
+        logger.info("Stage %i finished, return was: %i", self.index, ret)
+        return self.finishStep(ret), self.stats
+
+    def finishStep(self, ret):
+        """publish the staged outputs of the current step (except any kept in
+        scratch space for later steps) if it succeeded, otherwise discard them;
+        returns the return code of the step, or None if publishing failed"""
+        self.releaseCachedInputs()
+        staged, self.staged = self.staged, None
+        if staged is None:
+            return ret
+        if ret != 0:
+            staged.remove()
+            return ret
+        keep = []
+        if self.keep_intermediates_local:
+            later_inputs = set(f for step in self.steps for f in step["inputs"])
+            keep = [f for f in staged.paths if f in later_inputs]
+        try:
+            staged.publish([f for f in staged.paths if f not in keep])
+        except (IOError, OSError):
+            logger.exception("Couldn't publish the outputs of stage %i", self.index)
+            staged.remove()
+            return None
+        if keep:
+            self.local.append(staged)
+            for f in keep:
+                self.local_paths[f] = staged.paths[f]
+            # (so the server doesn't journal the stage as finished: its outputs
+            # never make it to the shared filesystem)
+            self.stats["outputs_kept_local"] = True
+        else:
+            staged.remove()
+        return ret
+
+    def releaseCachedInputs(self):
+        for f in self.cached_inputs:
+            self.input_cache.release(f)
+        self.cached_inputs = []
+
+    def finishUnit(self):
+        """called once the unit is done: if a step failed, publish the outputs
+        kept in scratch space after all (so the failed step can be rerun, e.g.
+        on another executor), then clean up the scratch space"""
+        succeeded = not self.results or self.results[-1][1] == 0
+        for staged in self.local:
+            if not succeeded:
+                try:
+                    staged.publish([f for f in staged.paths if f in self.local_paths])
+                except (IOError, OSError):
+                    logger.exception("Couldn't publish the outputs kept in %s", staged.dir)
+                    # so the steps which produced them are rerun
+                    self.results = [(i, ret if ret != 0 else None, stats)
+                                    for i, ret, stats in self.results]
+            staged.remove()
+        if not succeeded:
+            # (the outputs were published after all, or the steps are reported as failed)
+            for _, _, stats in self.results:
+                if stats:
+                    stats.pop("outputs_kept_local", None)
+        self.local = []
+        self.local_paths = {}
+        self.releaseCachedInputs()
+        if self.staged is not None:
+            self.staged.remove()
+            self.staged = None
 
 class pipelineExecutor():
     def __init__(self, options):
@@ -254,29 +499,90 @@ class pipelineExecutor():
         self.runningMem = 0.0
         self.runningProcs = 0   
         self.runningChildren = [] # no scissors (i.e. children should not run around with sharp objects...)
-        self.pool = None
         self.pyro_proxy_for_server = None
         self.clientURI = None
         self.serverURI = None
-        self.current_running_job_pids = []
         self.registered_with_server = False
-        # we associate an event with each executor which is set when jobs complete.
-        # in the future it might also be set by the server, and we might have more
-        # than one event (for reclaiming, server messages, ...)
-        self.e = threading.Event()
+        # we associate an event with each executor which is set when jobs complete
+        # (by SIGCHLD), when their completion has been reported, and by the server
+        # when there are stages for us (see WakeupPipe)
+        self.e = None
+        # (index, return code, statistics) of terminated stages not yet reported to the server
+        self.completions = []
+        self.completions_cv = threading.Condition()
+        # the thread reporting them (see reportCompletions), and whether it should stop
+        self.reporter = None
+        self.stop_reporting = False
+        # admit stages by the memory our stages actually use (see memFree)?
+        self.measured_memory_admission = options.measured_memory_admission
+        self.memory_headroom = options.memory_headroom
+        self.suspend_on_memory_pressure = options.suspend_on_memory_pressure
+        # when we last suspended or resumed a unit
+        self.last_memory_action = None
+        # node-local directory the outputs of stages are staged in (if any)
+        self.scratch_dir = os.path.expandvars(options.scratch_dir) if options.scratch_dir else None
+        self.keep_chain_intermediates_local = options.keep_chain_intermediates_local
+        # node-local cache of input files (if any; see initializeInputCache)
+        self.input_cache_dir = os.path.expandvars(options.input_cache_dir) if options.input_cache_dir else None
+        self.input_cache_size = options.input_cache_size
+        self.input_cache = None
+        # hands out the CPUs the units we run are pinned to (if any)
+        self.cpu_allocator = None
+        self.taskset = None
+        if options.pin_stage_cpus:
+            cpus = ca.getAffinity()
+            self.taskset = ca.tasksetPath()
+            if cpus is None:
+                logger.warn("Can't determine the CPUs available to the executor; not pinning stages to CPUs")
+            elif self.taskset is None:
+                logger.warn("taskset isn't installed; not pinning stages to CPUs")
+            else:
+                self.cpu_allocator = ca.CPUAllocator(cpus)
         
     def registeredWithServer(self):
         self.registered_with_server = True
         
-    def addPIDtoRunningList(self, pid):
-        self.current_running_job_pids.append(pid)
-    
-    def removePIDfromRunningList(self, pid):
-        self.current_running_job_pids.remove(pid)
-
-    def initializePool(self):
-        self.pool = Pool(processes = self.procs)
+    def initializeChildReaping(self):
+        # the commands of stages are run directly as our child processes (so
+        # the number we run is only limited by our mem and procs); the main loop
+        # is woken up by SIGCHLD when one exits, and reaps it (see reapChildren).
+        # (this has to be called from the main thread, which handles signals)
+        self.e = WakeupPipe()
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        # restart system calls interrupted by SIGCHLD (other than select)
+        signal.siginterrupt(signal.SIGCHLD, False)
+        # (children stopped or continued with --suspend-on-memory-pressure also
+        # wake us up, but there's nothing to reap then)
+        signal.set_wakeup_fd(self.e.w)
         
+    def checkScratchDir(self):
+        """make sure that the scratch directory (if any) exists, creating it if
+        need be, and that we can create the staging directories of stages in it;
+        exit with an error otherwise"""
+        if self.scratch_dir is None:
+            return
+        try:
+            try:
+                os.makedirs(self.scratch_dir)
+            except OSError as e:
+                # (other executors on the node may have created it just now)
+                if e.errno != errno.EEXIST or not os.path.isdir(self.scratch_dir):
+                    raise
+            os.rmdir(tempfile.mkdtemp(prefix="scratch-check-", dir=self.scratch_dir))
+        except (OSError, IOError) as e:
+            msg = ("Error: can't use %s as the scratch directory (--scratch-dir): %s. Exiting..."
+                   % (self.scratch_dir, e.strerror or e))
+            logger.error(msg)
+            print(msg)
+            sys.exit(1)
+
+    def initializeInputCache(self):
+        # (not in __init__, since local_launch runs several copies of an executor,
+        # each of which should have a cache of its own)
+        if self.input_cache_dir is not None:
+            self.input_cache = staging.InputCache(self.input_cache_dir,
+                                                  self.input_cache_size * 1024 ** 3)
+
     def setClientURI(self, cURI):
         self.clientURI = cURI 
             
@@ -289,32 +595,46 @@ class pipelineExecutor():
     # TODO rename completeAndExitChildren,generalShutdownCall to something like
     # normalShutdown, dirtyShutdown
     def generalShutdownCall(self):
-        # stop the worker processes (children) immediately without completing outstanding work
-        # Initially I wanted to stop the running processes using pool.terminate() and pool.join()
-        # but the keyboard interrupt handling proved tricky. Instead, the executor now keeps
-        # track of the process IDs (pid) of the current running jobs. Those are targetted by
-        # os.kill in order to stop the processes in the Pool
+        # stop the running commands (children) immediately without completing outstanding work
         logger.debug("Executor shutting down.  Killing running jobs:")
-        for subprocID in self.current_running_job_pids:
-            os.kill(subprocID, signal.SIGTERM)
-        # FIXME the death of the child process causes runStage
-        # to notify the server of the job's destruction
-        # so the job is no longer in the client's set of stages
-        # when unregisterClient is called
+        for child in self.runningChildren:
+            if child.process is not None and child.process.returncode is None:
+                try:
+                    os.kill(child.process.pid, signal.SIGTERM)
+                    if child.suspended:
+                        # (otherwise the SIGTERM isn't handled)
+                        self.signalChild(child, signal.SIGCONT)
+                except OSError:
+                    pass
+            # (the server reruns the unit's stages, including those not yet
+            # reported, so any outputs in scratch space aren't needed)
+            child.finishUnit()
+        # the server considers stages still running on us lost when we unregister
         self.unregister_with_server()
 
     def completeAndExitChildren(self):
         # This function is called under normal circumstances (i.e., not because
-        # of a keyboard interrupt). So we can close the pool of processes 
-        # in the normal way (don't need to use the pids here)
-        # prevent more jobs from starting, and exit
-        if len(self.current_running_job_pids) > 0:
-            self.pool.close()
-            # wait for the worker processes (children) to exit (must be called after terminate() or close()
-            self.pool.join()
+        # of a keyboard interrupt). We don't start any more units, but wait for the
+        # ones we're running (children) to finish, and exit
+        while self.runningChildren:
+            # (we no longer ask the server for stages, which is when memory
+            # pressure is normally relieved, but units suspended on memory
+            # pressure still need to be resumed to finish)
+            if any(c.suspended for c in self.runningChildren):
+                self.memFree()
+            self.e.wait(WAIT_TIMEOUT)
+            self.e.clear()
+            self.reapChildren()
         self.unregister_with_server()
 
     def unregister_with_server(self):
+        # report any stages which terminated since the last report, and make
+        # sure no more reports are sent once we've begun to unregister
+        self.stopReporting()
+        self.sendCompletions()
+        if self.input_cache is not None:
+            logger.info(self.input_cache.summary())
+            self.input_cache.remove()
         if self.registered_with_server:
             # unset the registered flag before calling unregisterClient
             # to prevent an (unimportant) race condition wherein the
@@ -402,30 +722,213 @@ class pipelineExecutor():
                 return True
         return False
     
-    def free_resources(self):
-        # Free up resources from any completed (successful or otherwise) stages
-        for child in self.runningChildren:
-            if child.result.ready():
-                logger.debug("Freeing up resources for stage %i.", child.stage)
-                self.runningMem -= child.mem
-                self.runningProcs -= child.procs
-                self.runningChildren.remove(child)
-
-    def notifyStageTerminated(self, i, returncode=None):
-        #try:
-            if returncode == 0:
-                self.pyro_proxy_for_server.setStageFinished(i, self.clientURI)
+    def runUnit(self, unit):
+        child = ChildProcess(unit, self.scratch_dir, self.keep_chain_intermediates_local,
+                             self.input_cache)
+        if self.cpu_allocator is not None:
+            # (if there aren't enough CPUs left, e.g. because --proc is larger than
+            # the number of CPUs, the unit just isn't pinned)
+            child.cpus = self.cpu_allocator.allocate(child.procs)
+            child.taskset = self.taskset
+        self.runningMem += child.mem
+        self.runningProcs += child.procs
+        self.runningChildren.append(child)
+        logger.debug("Added stage %i to the running children.", child.stage)
+        if not self.runNextStep(child):
+            self.finishUnit(child)
+
+    def runNextStep(self, child):
+        """start the next step of the child's unit, if any; returns True if
+        one is running"""
+        if not child.steps:
+            return False
+        try:
+            child.startNextStep()
+        except Exception:
+            logger.exception("Exception whilst running stage: %i", child.index)
+            # a None return code means the stage couldn't be run
+            child.results.append((child.index, None, child.stats))
+            return False
+        return True
+
+    def reapChildren(self):
+        # report the stages whose commands have exited to the server, and run
+        # the next steps of their units or free up their resources
+        # (iterate over a copy since we remove finished children as we go)
+        for child in self.runningChildren[:]:
+            try:
+                result = child.poll()
+            except OSError:
+                logger.exception("Couldn't reap the command of stage %i", child.index)
+                result = (None, child.stats)
+            if result is None:
+                continue
+            returncode, stats = result
+            child.results.append((child.index, returncode, stats))
+            if returncode == 0 and self.runNextStep(child):
+                # (stages whose outputs are kept in scratch space for the rest of
+                # the unit are only reported once it's done, so if we don't get
+                # that far, the server reruns them)
+                if not child.local:
+                    self.reportResults(child)
             else:
-                # a None returncode is also considered a failure
-                self.pyro_proxy_for_server.setStageFailed(i, self.clientURI)
-        #except Pyro4.errors.CommunicationError:
+                self.finishUnit(child)
+
+    def finishUnit(self, child):
+        child.finishUnit()
+        self.reportResults(child)
+        self.free_resources(child)
+
+    def reportResults(self, child):
+        for i, returncode, stats in child.results:
+            self.notifyStageTerminated(i, returncode, stats)
+        child.results = []
+
+    def free_resources(self, child):
+        # Free up resources of a completed (successful or otherwise) unit
+        logger.debug("Freeing up resources for stage %i.", child.stage)
+        self.runningMem -= child.mem
+        self.runningProcs -= child.procs
+        if self.cpu_allocator is not None:
+            self.cpu_allocator.release(child.cpus)
+        self.runningChildren.remove(child)
+
+    def notifyStageTerminated(self, i, returncode=None, stats=None):
+        # (reportCompletions passes this on to the server)
+        with self.completions_cv:
+            self.completions.append((i, returncode, stats))
+            self.completions_cv.notify()
+
+    def startReporting(self):
+        self.reporter = threading.Thread(target=self.reportCompletions)
+        self.reporter.daemon = True
+        self.reporter.start()
+
+    def stopReporting(self):
+        """make the reporting thread send what's left to report and exit, and
+        wait for it to do so"""
+        with self.completions_cv:
+            self.stop_reporting = True
+            self.completions_cv.notify()
+        if self.reporter is not None and self.reporter is not threading.current_thread():
+            self.reporter.join()
+        self.reporter = None
+
+    def reportCompletions(self):
+        try:
+            while True:
+                with self.completions_cv:
+                    while not self.completions and not self.stop_reporting:
+                        self.completions_cv.wait()
+                    if not self.completions:
+                        # (we've been told to stop, and there's nothing left to report)
+                        return
+                    # give other stages finishing around the same time a chance
+                    # to be reported in the same request
+                    deadline = time.time() + COMPLETION_REPORT_WINDOW
+                    while len(self.completions) < COMPLETION_REPORT_SIZE and not self.stop_reporting:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self.completions_cv.wait(remaining)
+                self.sendCompletions()
+        except:
+            logger.exception("Completion reporting thread crashed: ")
+
+    def sendCompletions(self):
+        with self.completions_cv:
+            batch, self.completions = self.completions, []
+        if not batch:
+            return
+        try:
+            self.pyro_proxy_for_server.setStagesTerminated(self.clientURI, batch)
+        except Exception:
             # the server may have shutdown or otherwise become unavailable
             # (currently this is expected when a long-running job completes;
             # we should add a more elegant check for this state of affairs),
             # but the executor may have running jobs that shouldn't be killed
-            # TODO add similar error handling around certain other Pyro calls)
-        #    logger.info("Error communing with server; couldn't notify it of stage %d's termination", i)
-            self.e.set()  # some work finished and server notified, so wake up
+            logger.exception("Error communing with server; couldn't notify it of the termination of stages %s",
+                             [i for i, _, _ in batch])
+        self.e.set()  # some work finished and server notified, so wake up
+
+    # called (oneway) by the server when stages we have room for become runnable,
+    # so that we ask for them right away instead of after WAIT_TIMEOUT
+    def wakeUp(self):
+        self.e.set()
+
+    def memFree(self):
+        """the memory (in G) we offer the server to run more stages in: normally
+        our memory minus that declared by the stages we're running, but with
+        --measured-memory-admission, our memory minus the headroom minus what
+        our stages actually use (or none, if that's more than we have)"""
+        declared = self.mem - self.runningMem
+        if not self.measured_memory_admission or not self.runningChildren:
+            # (when we're idle, offer all our memory, even if that's more than
+            # the limit, so stages needing all of it still get run)
+            return declared
+        roots = [c.process.pid for c in self.runningChildren if c.process is not None]
+        trees = rm.processTrees(roots)
+        if trees is None:
+            # no /proc, so all we can go by is the declared memory
+            return declared
+        now = time.time()
+        used = 0.0
+        # the memory of each unit (suspended units' memory stays in use, but
+        # they won't use any more until they're resumed)
+        usage = {}
+        for child in self.runningChildren:
+            rss = trees.get(child.process.pid, ([], 0.0))[1] if child.process is not None else 0.0
+            if now - child.started < MEMORY_WARMUP:
+                rss = max(rss, child.mem)
+            usage[child] = rss
+            used += rss
+        limit = self.mem * (1 - self.memory_headroom)
+        logger.debug("Measured memory use: %.2fG (declared: %.2fG, limit: %.2fG)", used, self.runningMem, limit)
+        if self.suspend_on_memory_pressure:
+            self.relieveMemoryPressure(usage, limit, trees, now)
+        if used >= limit or any(c.suspended for c in self.runningChildren):
+            # memory pressure: don't take on more stages until it's relieved
+            return 0
+        return limit - used
+
+    def relieveMemoryPressure(self, usage, limit, trees, now):
+        """suspend the most recently started unit if the units still running
+        use more memory than we have (unless it's the only one), and resume
+        suspended units (oldest first) once they'd fit under the limit along
+        with the running ones, or once no others are running (even if they
+        don't fit, otherwise they'd never finish); usage maps each unit to the
+        memory it uses.
+        Only one unit is suspended or resumed every MEMORY_PRESSURE_INTERVAL
+        seconds, since memory use takes a while to reflect the last action."""
+        if self.last_memory_action is not None and now - self.last_memory_action < MEMORY_PRESSURE_INTERVAL:
+            return
+        active = [c for c in self.runningChildren if not c.suspended and c.process is not None]
+        suspended = [c for c in self.runningChildren if c.suspended]
+        active_used = sum(usage[c] for c in active)
+        if active_used > self.mem and len(active) > 1:
+            child = max(active, key=lambda c: c.started)
+            logger.warn("Stages use %.2fG of memory (of %.2fG); suspending stage %i",
+                        active_used, self.mem, child.index)
+            self.signalChild(child, signal.SIGSTOP, trees)
+            child.suspended = True
+            self.last_memory_action = now
+        elif suspended:
+            child = min(suspended, key=lambda c: c.started)
+            if not active or active_used + usage[child] < limit:
+                logger.info("Resuming stage %i", child.index)
+                self.signalChild(child, signal.SIGCONT, trees)
+                child.suspended = False
+                self.last_memory_action = now
+
+    def signalChild(self, child, signum, trees=None):
+        # send the signal to the child's command and all of its descendants
+        if trees is None:
+            trees = rm.processTrees([child.process.pid]) or {}
+        for pid in trees.get(child.process.pid, ([child.process.pid], 0.0))[0]:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
 
     def idle(self):
         return self.runningMem == 0 and self.runningProcs == 0 and self.prev_time
@@ -458,14 +961,9 @@ class pipelineExecutor():
         self.prev_time = self.current_time
         self.current_time = time.time()
 
-        # a bit coarse but we can't call `free_resources` directly in a function
-        # such as notifyStageTerminated which is called from _within_ `runStage`
-        # since resources won't be freed soon enough, causing a false resource starvation.
-        # note we don't do resource accounting after leaving mainLoop, though that
-        # doesn't matter too much as there will never be new jobs
-        # (unless, in the future, we allow clients to connect to switch allegiances
-        # to other servers)
-        self.free_resources()
+        # reap the commands which have exited since we last woke up (SIGCHLD
+        # wakes us up when one does), freeing up the resources of finished units
+        self.reapChildren()
 
         if self.idle():
             self.idle_time += self.current_time - self.prev_time
@@ -482,13 +980,11 @@ class pipelineExecutor():
             logger.info("Time expired for accepting new jobs...leaving main loop.")
             return False
 
-        # TODO we get only one stage per loop iteration, so we have to wait for
-        # another event/timeout to get another.  In general we might want 
-        # getCommand to order multiple stages to be run on the same server
-        # (just setting the event immediately would be somewhat hackish)
-        cmd, i = self.pyro_proxy_for_server.getCommand(clientURIstr = self.clientURI,
-                                                       clientMemFree = self.mem - self.runningMem,
-                                                       clientProcsFree = self.procs - self.runningProcs)
+        # ask for as many stages as fit into our free resources at once,
+        # so we don't need a loop iteration (and event/timeout) per stage
+        cmd, stages = self.pyro_proxy_for_server.getCommands(clientURIstr = self.clientURI,
+                                                             clientMemFree = self.memFree(),
+                                                             clientProcsFree = self.procs - self.runningProcs)
         if cmd == "shutdown_normally":
             logger.debug('Saw shutdown command from server')
             return False
@@ -501,25 +997,12 @@ class pipelineExecutor():
         elif cmd == "wait":
             return True
         elif cmd == "run_stage":
-            stageMem, stageProcs = self.pyro_proxy_for_server.getStageMem(i), self.pyro_proxy_for_server.getStageProcs(i)
-            # we trust that the server has given us a stage
+            # we trust that the server has given us stages
             # that we have enough memory and processors to run ...
             # reset the idle time, we are running a stage!
             self.idle_time = 0
-            self.runningMem += stageMem
-            self.runningProcs += stageProcs
-            # The multiprocessing library must pickle things in order to execute them.
-            # I wanted the following function (runStage) to be a function of the pipelineExecutor
-            # class. That way we can access self.serverURI and self.clientURI from
-            # within the function. However, bound methods are not picklable (a bound method
-            # is a method that has "self" as its first argument, because if I understand 
-            # this correctly, that binds the function to a class instance). There is
-            # a way to make a bound function picklable, but this seems cumbersome. So instead
-            # runStage is now a standalone function.
-            result = self.pool.apply_async(runStage, (self.serverURI, self.clientURI, i))
-
-            self.runningChildren.append(ChildProcess(i, result, stageMem, stageProcs))
-            logger.debug("Added stage %i to the running pool.", i)
+            for stage in stages:
+                self.runUnit(stage)
             return True
         else:
             raise Exception("Got invalid cmd from server: %s" % cmd)
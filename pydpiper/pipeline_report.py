@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+import os
+import argparse
+import logging
+from cgi import escape
+from datetime import datetime
+from pydpiper.resource_model import StageStatsLog, programOf
+
+""" Summarize how the most recent run of a pydpiper pipeline spent its time,
+from the stage statistics (<pipeline_name>_stage_stats) recorded by the server
+while it ran: writes an HTML file with a timeline (Gantt chart) of the stages run by every executor,
+the number of processors in use over time, the realised critical path of the
+run and the stage types (programs) which took the most cluster time.
+
+The critical path is the chain of stages which actually determined when the
+pipeline finished: starting from the stage which finished last, we repeatedly
+step to its predecessor which finished last.  If the stages on it account for
+most of the makespan, the pipeline was limited by the shape of its graph (or
+by the slowest of its stages); if there are large gaps between them, stages
+were waiting for executors, and more of them would have helped."""
+
+logger = logging.getLogger(__name__)
+
+# width (in pixels) of the time axis of the charts, and height of a lane
+CHART_WIDTH = 1000
+LANE_HEIGHT = 14
+# number of stage types listed
+TOP_STAGE_TYPES = 15
+
+PALETTE = ["#4e79a7", "#f28e2b", "#59a14f", "#b07aa1", "#76b7b2",
+           "#edc948", "#ff9da7", "#9c755f", "#bab0ac", "#e15759"]
+
+def latestRun(records):
+    """the records of the most recent run of the pipeline (stage statistics
+    accumulate over restarts); records written before runs were identified
+    all count as one run, which is only used if there are no others"""
+    runs = [r["run"] for r in records if r.get("run") is not None]
+    if not runs:
+        return records
+    latest = max(runs)
+    return [r for r in records if r.get("run") == latest]
+
+def latestRecords(records):
+    """the most recent record of every stage (failed stages may have been
+    retried), as a dict from stage index to record; records without timing
+    information are ignored"""
+    latest = {}
+    for r in records:
+        if r.get("start") is None or r.get("walltime") is None or r.get("index") is None:
+            continue
+        previous = latest.get(r["index"])
+        if previous is None or r["start"] >= previous["start"]:
+            latest[r["index"]] = r
+    return latest
+
+def end(record):
+    return record["start"] + record["walltime"]
+
+def executorLanes(stages):
+    """assign the stages run by every executor to lanes such that stages in the
+    same lane don't overlap; returns a list of (executor, lanes) pairs in order
+    of the executors' first stage, where lanes is a list of lists of records"""
+    by_executor = {}
+    for r in sorted(stages.itervalues(), key=lambda r: r["start"]):
+        executor = r.get("executor") or r.get("host") or "unknown"
+        lanes = by_executor.setdefault(executor, [])
+        for lane in lanes:
+            if end(lane[-1]) <= r["start"]:
+                lane.append(r)
+                break
+        else:
+            lanes.append([r])
+    return sorted(by_executor.items(), key=lambda (_, lanes): lanes[0][0]["start"])
+
+def utilisation(stages):
+    """the number of processors in use over time, as a list of (time, procs)
+    pairs at which it changes"""
+    events = []
+    for r in stages.itervalues():
+        procs = r.get("procs", 1)
+        events.append((r["start"], procs))
+        events.append((end(r), -procs))
+    series = []
+    in_use = 0
+    # (at equal times, handle stages finishing first)
+    for t, delta in sorted(events, key=lambda (t, delta): (t, delta)):
+        in_use += delta
+        if series and series[-1][0] == t:
+            series[-1] = (t, in_use)
+        else:
+            series.append((t, in_use))
+    return series
+
+def criticalPath(stages):
+    """the realised critical path: a list of records, from the first stage of the
+    path to the one which finished last"""
+    if not stages:
+        return []
+    r = max(stages.itervalues(), key=end)
+    path = [r]
+    while True:
+        predecessors = [stages[j] for j in r.get("predecessors", []) if j in stages]
+        if not predecessors:
+            break
+        r = max(predecessors, key=end)
+        path.append(r)
+    path.reverse()
+    return path
+
+def stageTypes(stages):
+    """per program: a dict of the number of stages running it, their total
+    cluster time (wall time times processors, in s) and their mean and largest
+    wall time, as a list sorted by decreasing cluster time"""
+    types = {}
+    for r in stages.itervalues():
+        program = programOf(r)
+        t = types.setdefault(program, { "name" : program, "count" : 0, "cluster_seconds" : 0.0,
+                                        "walltime" : 0.0, "max_walltime" : 0.0 })
+        t["count"] += 1
+        t["cluster_seconds"] += r["walltime"] * r.get("procs", 1)
+        t["walltime"] += r["walltime"]
+        t["max_walltime"] = max(t["max_walltime"], r["walltime"])
+    for t in types.itervalues():
+        t["mean_walltime"] = t.pop("walltime") / t["count"]
+    return sorted(types.itervalues(), key=lambda t: t["cluster_seconds"], reverse=True)
+
+def summarize(records):
+    """everything in the report (on the most recent run), as a dict"""
+    run = latestRun(records)
+    stages = latestRecords(run)
+    if not stages:
+        return None
+    t0 = min(r["start"] for r in stages.itervalues())
+    makespan = max(end(r) for r in stages.itervalues()) - t0
+    path = criticalPath(stages)
+    path_time = sum(r["walltime"] for r in path)
+    series = utilisation(stages)
+    busy = sum(procs * (t2 - t1) for (t1, procs), (t2, _) in zip(series, series[1:]))
+    run_id = run[0].get("run") if run else None
+    return { "stages"          : stages,
+             "run"             : run_id,
+             "t0"              : t0,
+             "makespan"        : makespan,
+             "lanes"           : executorLanes(stages),
+             "utilisation"     : series,
+             "mean_procs"      : busy / makespan if makespan > 0 else 0.0,
+             "peak_procs"      : max(procs for _, procs in series),
+             "critical_path"   : path,
+             "critical_share"  : path_time / makespan if makespan > 0 else 1.0,
+             "stage_types"     : stageTypes(stages) }
+
+def colourOf(name, colours):
+    if name not in colours:
+        colours[name] = PALETTE[len(colours) % len(PALETTE)]
+    return colours[name]
+
+def ganttSVG(report):
+    scale = CHART_WIDTH / max(report["makespan"], 1e-9)
+    on_path = set(r["index"] for r in report["critical_path"])
+    colours = {}
+    rows = []
+    y = 0
+    for executor, lanes in report["lanes"]:
+        rows.append('<text x="0" y="%d" font-size="11">%s</text>' % (y + 11, escape(executor)))
+        y += LANE_HEIGHT
+        for lane in lanes:
+            for r in lane:
+                x = (r["start"] - report["t0"]) * scale
+                w = max(r["walltime"] * scale, 1)
+                stroke = ' stroke="black" stroke-width="2"' if r["index"] in on_path else ''
+                rows.append('<rect x="%.1f" y="%d" width="%.1f" height="%d" fill="%s"%s>'
+                            '<title>stage %d: %s (%.1f s)</title></rect>'
+                            % (x, y, w, LANE_HEIGHT - 2, colourOf(r.get("name"), colours), stroke,
+                               r["index"], escape(str(r.get("name"))), r["walltime"]))
+            y += LANE_HEIGHT
+    return ('<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d">%s</svg>'
+            % (CHART_WIDTH, y, "".join(rows)))
+
+def utilisationSVG(report, height=150):
+    xscale = CHART_WIDTH / max(report["makespan"], 1e-9)
+    yscale = float(height) / max(report["peak_procs"], 1)
+    points = []
+    for (t, procs) in report["utilisation"]:
+        x = (t - report["t0"]) * xscale
+        if points:
+            points.append("%.1f,%.1f" % (x, height - previous * yscale))
+        points.append("%.1f,%.1f" % (x, height - procs * yscale))
+        previous = procs
+    return ('<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d">'
+            '<polyline fill="none" stroke="#4e79a7" points="%s"/></svg>'
+            % (CHART_WIDTH, height, " ".join(points)))
+
+def writeHTML(report, path):
+    html = ["<html><head><title>Pipeline report</title></head><body>",
+            "<h1>Pipeline report</h1>",
+            "<p>%s</p>" % ("Run started %s" % datetime.fromtimestamp(report["run"]).strftime("%Y-%m-%d %H:%M:%S")
+                           if report["run"] is not None else
+                           "All runs recorded (the statistics don't identify individual runs)"),
+            "<p>%d stages; makespan %.1f s; processors in use: %.1f on average, %d at peak</p>"
+            % (len(report["stages"]), report["makespan"], report["mean_procs"], report["peak_procs"]),
+            "<h2>Timeline per executor</h2>",
+            "<p>(stages on the critical path are outlined)</p>",
+            ganttSVG(report),
+            "<h2>Processors in use</h2>",
+            utilisationSVG(report),
+            "<h2>Critical path</h2>",
+            "<p>%d stages accounting for %.0f%% of the makespan (the rest was spent waiting to be run)</p>"
+            % (len(report["critical_path"]), 100 * report["critical_share"]),
+            "<table border=\"1\"><tr><th>stage</th><th>name</th><th>host</th>"
+            "<th>waited (s)</th><th>wall time (s)</th></tr>"]
+    previous_end = report["t0"]
+    for r in report["critical_path"]:
+        html.append("<tr><td>%d</td><td>%s</td><td>%s</td><td>%.1f</td><td>%.1f</td></tr>"
+                    % (r["index"], escape(str(r.get("name"))), escape(str(r.get("host"))),
+                       r["start"] - previous_end, r["walltime"]))
+        previous_end = end(r)
+    html += ["</table>",
+             "<h2>Programs by cluster time</h2>",
+             "<table border=\"1\"><tr><th>program</th><th>stages</th><th>cluster time (s)</th>"
+             "<th>mean wall time (s)</th><th>largest wall time (s)</th></tr>"]
+    for t in report["stage_types"][:TOP_STAGE_TYPES]:
+        html.append("<tr><td>%s</td><td>%d</td><td>%.1f</td><td>%.1f</td><td>%.1f</td></tr>"
+                    % (escape(str(t["name"])), t["count"], t["cluster_seconds"],
+                       t["mean_walltime"], t["max_walltime"]))
+    html.append("</table></body></html>")
+    with open(path, 'w') as f:
+        f.write("\n".join(html))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("stats_file", type=str,
+                        help="stage statistics file written by the server (<pipeline_name>_stage_stats)")
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="HTML file to write [default: <stats_file>_report.html]")
+
+    options = parser.parse_args()
+    output = options.output or options.stats_file + "_report.html"
+
+    report = summarize(StageStatsLog(options.stats_file).read())
+    if report is None:
+        print "No timing information found in %s" % options.stats_file
+    else:
+        writeHTML(report, output)
+        print "Makespan:                    %.1f s" % report["makespan"]
+        print "Mean/peak processors in use: %.1f/%d" % (report["mean_procs"], report["peak_procs"])
+        print "Critical path:               %d stages, %.0f%% of the makespan" % (len(report["critical_path"]),
+                                                                                  100 * report["critical_share"])
+        print "Report written to %s" % os.path.abspath(output)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+import os
+import json
+import logging
+
+"""Observed resource usage of stages, and a model of it learned from them.
+
+Executors measure the wall time, CPU time, peak memory (resident set size)
+and I/O of every stage they run; the server adds the host it ran on and how
+long it waited to be dispatched, and appends these observations, one JSON
+object per line, to a stage statistics file next to the finished stages
+journal, so that they accumulate over runs (and restarts) of a pipeline.
+
+The model predicts the memory a stage needs from observations of stages
+running the same program (not stages with the same name, since names often
+include parameters or the subject): for each program it fits the peak memory as a
+linear function of the total size of the stage's input files (a proxy for
+their number of voxels) by least squares, up to the largest peak memory
+observed, and adds a safety margin.  Stages with too few observations keep
+their default memory requirements."""
+
+# don't predict anything for programs with fewer observations than this
+MIN_OBSERVATIONS = 3
+# by default, ask for this fraction more memory than predicted
+MEMORY_SAFETY_MARGIN = 0.2
+# never ask for less memory (in G) than this
+MIN_MEMORY = 0.1
+
+logger = logging.getLogger(__name__)
+
+class StageStatsLog():
+    def __init__(self, path):
+        self.path = path
+        self.fh = None
+
+    def read(self):
+        """returns the list of records (dicts) in the file (if any)"""
+        records = []
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # e.g., a line torn by a crash
+                        pass
+        except IOError:
+            logger.info("Stage statistics file %s doesn't exist yet", self.path)
+        return records
+
+    def record(self, record):
+        if self.fh is None:
+            self.fh = open(self.path, 'a')
+        self.fh.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def flush(self):
+        if self.fh is not None:
+            self.fh.flush()
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+def programOf(record):
+    """the program a stage statistics record is about (records written before
+    the program was recorded only have the stage name, whose first word is
+    usually the program)"""
+    program = record.get("program")
+    if program:
+        return program
+    words = (record.get("name") or "").split()
+    return os.path.basename(words[0]) if words else ""
+
+def fitLine(xs, ys):
+    """least-squares fit of y = a + b*x; returns (a, b)"""
+    n = float(len(xs))
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    if var_x == 0:
+        return (mean_y, 0.0)
+    b = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+    return (mean_y - b * mean_x, b)
+
+class ResourceModel():
+    def __init__(self, records, margin=MEMORY_SAFETY_MARGIN):
+        self.margin = margin
+        observations = {}
+        for r in records:
+            # stages which failed (e.g., were killed for using too much memory)
+            # don't tell us how much memory they need
+            if r.get("returncode") != 0 or r.get("maxrss") is None:
+                continue
+            observations.setdefault(programOf(r), []).append((r.get("input_bytes", 0), r["maxrss"]))
+        # program -> (a, b, largest observed peak memory)
+        self.fits = {}
+        for program, obs in observations.iteritems():
+            if len(obs) < MIN_OBSERVATIONS:
+                continue
+            xs = [float(x) for x, _ in obs]
+            ys = [float(y) for _, y in obs]
+            a, b = fitLine(xs, ys)
+            self.fits[program] = (a, b, max(ys))
+        logger.info("Learned memory requirements of %d programs from %d observations",
+                    len(self.fits), sum(len(obs) for obs in observations.itervalues()))
+
+    def predictMem(self, program, input_bytes, default):
+        """the memory (in G) a stage running the program on input files of the
+        given total size should ask for, or default if we can't tell"""
+        fit = self.fits.get(program)
+        if fit is None:
+            return default
+        a, b, largest = fit
+        # a negative slope is an artifact of noisy observations, so don't
+        # extrapolate from it; just use the largest peak seen.  Nor do we
+        # extrapolate beyond that, since a steep fit would soon ask for more
+        # memory than any executor has
+        predicted = min(a + b * input_bytes, largest) if b >= 0 else largest
+        return max(predicted * (1 + self.margin), MIN_MEMORY)
+
+# the I/O counters of /proc/<pid>/io we record (the *char counters include
+# reads and writes served by the page cache, the *_bytes ones don't)
+PROC_IO_FIELDS = ("rchar", "wchar", "read_bytes", "write_bytes")
+
+def processState(pid):
+    """the state (e.g., 'R', 'S', or 'Z' for a zombie) of a process according
+    to /proc/<pid>/stat, or None if that can't be read"""
+    try:
+        with open("/proc/%d/stat" % pid, 'r') as f:
+            # (the command name in parentheses may itself contain spaces)
+            return f.read().rsplit(')', 1)[1].split()[0]
+    except (IOError, IndexError):
+        return None
+
+def processIO(pid):
+    """the I/O counters (in bytes) of a process, including those of its reaped
+    children, from /proc/<pid>/io, or {} if that can't be read"""
+    counters = {}
+    try:
+        with open("/proc/%d/io" % pid, 'r') as f:
+            for line in f:
+                field, _, value = line.partition(':')
+                if field in PROC_IO_FIELDS:
+                    counters[field] = int(value)
+    except (IOError, ValueError):
+        return {}
+    return counters
+
+def processTrees(roots):
+    """the processes descended from (and including) each of the given processes
+    and their total resident set size, from /proc: a dict from the pid of each
+    (existing) root to a pair of the list of pids in its tree and their RSS in G,
+    or None if /proc isn't available"""
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return None
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    children = {}
+    rss = {}
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry, 'r') as f:
+                # (after the command name: state, ppid, ..., rss (in pages) is the 22nd field)
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            # the process has exited in the meantime
+            continue
+        pid = int(entry)
+        children.setdefault(int(fields[1]), []).append(pid)
+        rss[pid] = int(fields[21]) * page_size / 1024.0 ** 3
+    trees = {}
+    for root in roots:
+        if root not in rss:
+            continue
+        pids = []
+        todo = [root]
+        while todo:
+            pid = todo.pop()
+            pids.append(pid)
+            todo.extend(children.get(pid, []))
+        trees[root] = (pids, sum(rss[pid] for pid in pids))
+    return trees
+
+def inputBytes(files):
+    """total size of the (existing) files"""
+    total = 0
+    for f in files:
+        try:
+            total += os.path.getsize(f)
+        except OSError:
+            pass
+    return total
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+from array import array
+from itertools import izip
+
+"""A compact directed acyclic graph of pipeline stages.
+
+Nodes are the integer stage indices 0..n-1.  The edges are given in bulk
+(as parallel arrays of source and target indices) and stored in compressed
+sparse row form: for each direction an offsets array of length n+1 and an
+indices array with one entry per edge, so that the successors of node i are
+succ_indices[succ_offsets[i]:succ_offsets[i+1]].  This uses a few bytes per
+node and edge instead of the dict-of-dicts of a networkx.DiGraph."""
+
+def compressRows(n, rows, columns):
+    """given parallel arrays of (row, column) pairs, return the offsets and
+    indices arrays of the corresponding compressed sparse row structure"""
+    offsets = array('i', [0]) * (n + 1)
+    for r in rows:
+        offsets[r + 1] += 1
+    for i in xrange(n):
+        offsets[i + 1] += offsets[i]
+    indices = array('i', [0]) * len(rows)
+    fill = offsets[:-1]
+    for r, c in izip(rows, columns):
+        indices[fill[r]] = c
+        fill[r] += 1
+    return offsets, indices
+
+class StageGraph():
+    def __init__(self):
+        self.n = 0
+        self.succ_offsets = array('i', [0])
+        self.succ_indices = array('i')
+        self.pred_offsets = array('i', [0])
+        self.pred_indices = array('i')
+
+    def add_node(self):
+        """adds a node without any edges; returns its index"""
+        self.n += 1
+        self.succ_offsets.append(self.succ_offsets[-1])
+        self.pred_offsets.append(self.pred_offsets[-1])
+        return self.n - 1
+
+    def set_edges(self, sources, targets):
+        """replaces all edges by the ones given as parallel arrays of source
+        and target nodes (which should not contain duplicates)"""
+        self.succ_offsets, self.succ_indices = compressRows(self.n, sources, targets)
+        self.pred_offsets, self.pred_indices = compressRows(self.n, targets, sources)
+
+    def number_of_nodes(self):
+        return self.n
+
+    def number_of_edges(self):
+        return len(self.succ_indices)
+
+    def nodes_iter(self):
+        return iter(xrange(self.n))
+
+    def successors_iter(self, i):
+        return iter(self.succ_indices[self.succ_offsets[i]:self.succ_offsets[i + 1]])
+
+    def predecessors_iter(self, i):
+        return iter(self.pred_indices[self.pred_offsets[i]:self.pred_offsets[i + 1]])
+
+    def successors(self, i):
+        return list(self.successors_iter(i))
+
+    def predecessors(self, i):
+        return list(self.predecessors_iter(i))
+
+    def out_degree(self, i):
+        return self.succ_offsets[i + 1] - self.succ_offsets[i]
+
+    def in_degree(self, i):
+        return self.pred_offsets[i + 1] - self.pred_offsets[i]
+
+    def descendants(self, i):
+        """returns all nodes reachable from i (not including i)"""
+        seen = bytearray(self.n)
+        seen[i] = 1
+        stack = [i]
+        result = []
+        while stack:
+            for j in self.successors_iter(stack.pop()):
+                if not seen[j]:
+                    seen[j] = 1
+                    result.append(j)
+                    stack.append(j)
+        return result
+
+    def topological_order(self):
+        """returns the nodes ordered such that every node precedes its successors"""
+        remaining = array('i', [self.in_degree(i) for i in xrange(self.n)])
+        order = [i for i in xrange(self.n) if remaining[i] == 0]
+        for i in order: # order grows as we go
+            for j in self.successors_iter(i):
+                remaining[j] -= 1
+                if remaining[j] == 0:
+                    order.append(j)
+        if len(order) != self.n:
+            raise Exception("the stage graph contains a cycle")
+        return order
+
+    def to_networkx(self, labels=None, colours=None):
+        """returns an equivalent networkx.DiGraph, e.g., to write a .dot file;
+        networkx is only needed when this is called"""
+        import networkx as nx
+        G = nx.DiGraph()
+        for i in xrange(self.n):
+            attributes = {}
+            if labels is not None:
+                attributes["label"] = labels[i]
+            if colours is not None:
+                attributes["color"] = colours[i]
+            G.add_node(i, **attributes)
+        for i in xrange(self.n):
+            for j in self.successors_iter(i):
+                G.add_edge(i, j)
+        return G
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+from array import array
+
+"""Compact store of the server's per-stage scheduling state.
+
+Rather than keeping the status, number of retries and resource requirements
+as attributes of every PipelineStage object, they are kept in typed arrays
+indexed by stage, together with a bitmap of processed (finished or given up
+on) stages and counters of the number of stages in each status, so that
+status queries and the completion check are constant-time."""
+
+# status codes, and the names used for them in the rest of the code
+NONE, RUNNING, FINISHED, FAILED = range(4)
+STATUS_NAMES = [None, "running", "finished", "failed"]
+STATUS_CODES = dict((name, code) for code, name in enumerate(STATUS_NAMES))
+
+class StageStates():
+    def __init__(self):
+        self.status  = array('b')
+        self.retries = array('H')
+        self.mem     = array('d')
+        self.procs   = array('i')
+        # one bit per stage
+        self.processed = bytearray()
+        self.number_processed = 0
+        # number of stages with each status code
+        self.counts = [0] * len(STATUS_NAMES)
+
+    def __len__(self):
+        return len(self.status)
+
+    def add(self, mem, procs):
+        """adds the state of a new stage; returns its index"""
+        i = len(self.status)
+        self.status.append(NONE)
+        self.retries.append(0)
+        self.mem.append(mem)
+        self.procs.append(procs)
+        if i % 8 == 0:
+            self.processed.append(0)
+        self.counts[NONE] += 1
+        return i
+
+    def getStatus(self, i):
+        return STATUS_NAMES[self.status[i]]
+
+    def setStatus(self, i, status):
+        code = STATUS_CODES[status]
+        self.counts[self.status[i]] -= 1
+        self.counts[code] += 1
+        self.status[i] = code
+
+    def isFinished(self, i):
+        return self.status[i] == FINISHED
+
+    def isRunning(self, i):
+        return self.status[i] == RUNNING
+
+    def count(self, status):
+        """number of stages with the given status"""
+        return self.counts[STATUS_CODES[status]]
+
+    def incrementRetries(self, i):
+        self.retries[i] += 1
+
+    def isProcessed(self, i):
+        return bool(self.processed[i >> 3] & (1 << (i & 7)))
+
+    def setProcessed(self, i):
+        """marks stage i as processed; returns False if it already was"""
+        if self.isProcessed(i):
+            return False
+        self.processed[i >> 3] |= 1 << (i & 7)
+        self.number_processed += 1
+        return True
+
+    def processedStages(self):
+        return [i for i in xrange(len(self.status)) if self.isProcessed(i)]
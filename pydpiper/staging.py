@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+import os
+import stat
+import errno
+import shutil
+import socket
+import hashlib
+import tempfile
+import threading
+import Queue
+import logging
+from collections import OrderedDict
+
+"""Staging of the outputs and inputs of stages in node-local scratch space.
+
+With --scratch-dir, an executor runs the command of each stage with the paths
+of its output files replaced by paths in a fresh directory in scratch space
+(e.g., $TMPDIR or /dev/shm), so the command's writes don't go to the shared
+filesystem.  If the command succeeds, the outputs are published, i.e., moved
+to their final locations such that they appear there complete or not at all
+(by copying them next to their final location and renaming them); if it
+fails, they're discarded, so no partially written outputs are left behind.
+
+Only output files appearing as arguments of the command by themselves can be
+staged, and transforms (.xfm) never are, since they refer to the grid files
+written next to them by name.
+
+With --input-cache-dir, an executor also keeps copies of input files read by
+several of its stages (e.g., the atlases, masks and model averages read by
+most stages of MAGeT or a model building pipeline) in node-local scratch
+space, and runs stages on those copies rather than on the files on the
+shared filesystem once they've been copied (see InputCache)."""
+
+logger = logging.getLogger(__name__)
+
+# outputs with these extensions are written to their final locations directly
+UNSTAGED_EXTENSIONS = (".xfm",)
+# number of files asked for only once (so not yet copied) the input cache
+# keeps track of; beyond that, it forgets those asked for longest ago
+MAX_TRACKED_REQUESTS = 10000
+
+def isStageable(path):
+    return os.path.splitext(path)[1] not in UNSTAGED_EXTENSIONS
+
+class StagedOutputs():
+    """The outputs of one stage being written to a scratch directory: a map
+    from the final path of each staged output to its path in scratch space."""
+    def __init__(self, scratch_dir, index, argv, outputs):
+        self.dir = tempfile.mkdtemp(prefix="stage-%d-" % index, dir=scratch_dir)
+        self.paths = {}
+        args = set(argv)
+        for k, f in enumerate(outputs):
+            if f in args and isStageable(f) and f not in self.paths:
+                # (numbered, since outputs in different directories may have the
+                # same name, but keeping the name, whose extension matters to tools)
+                self.paths[f] = os.path.join(self.dir, "%d_%s" % (k, os.path.basename(f)))
+
+    def publish(self, finals=None):
+        """move the (given) outputs to their final locations"""
+        for f in (finals if finals is not None else self.paths.keys()):
+            if not os.path.exists(self.paths[f]):
+                # (as when writing to the final location directly, it's up to
+                # the stages using the file to complain about its absence)
+                logger.warn("Output file %s wasn't written", f)
+                continue
+            publishFile(self.paths[f], f)
+
+    def remove(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+def publishFile(src, dest):
+    """move src to dest such that dest appears atomically: by renaming it if
+    they're on the same filesystem, otherwise by copying it to a temporary file
+    next to dest and renaming that"""
+    try:
+        os.rename(src, dest)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    tmp = "%s.%s-%d.tmp" % (dest, socket.gethostname(), os.getpid())
+    try:
+        shutil.copyfile(src, tmp)
+        os.rename(tmp, dest)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.remove(src)
+
+class CacheEntry():
+    __slots__ = ("mtime", "size", "path", "users")
+    def __init__(self, mtime, size, path):
+        self.mtime = mtime
+        self.size = size
+        # the copy in the cache, and the number of running stages using it
+        self.path = path
+        self.users = 0
+
+class InputCache():
+    """A size-bounded cache of copies of input files, evicting the least recently
+    used ones.  Copies are identified by the path, modification time and size
+    of the original, so a file which has changed since it was copied is copied
+    anew.  A file is only copied the second time it's asked for, so inputs read
+    by just one stage don't take up (and churn) the space; copies used by
+    running stages are never evicted.  Files are copied by a thread of the
+    cache's own, so that copying a large file doesn't hold up the executor:
+    stages read the original until the copy is done."""
+    def __init__(self, cache_dir, budget):
+        # (a directory of our own, since other executors on the node may be
+        # using the same cache directory)
+        self.dir = tempfile.mkdtemp(prefix="input-cache-", dir=cache_dir)
+        self.budget = budget
+        # (including the space reserved for the copies being made)
+        self.used = 0
+        # original path -> CacheEntry, least recently used first
+        self.entries = OrderedDict()
+        # (path, mtime, size) -> number of times asked for, of files not (yet)
+        # copied, least recently first asked for first
+        self.requests = OrderedDict()
+        # original path -> size, of the files being copied
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.removed = False
+        # (the copying thread updates the entries, pending and used)
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.copier = threading.Thread(target=self.copyFiles)
+        self.copier.daemon = True
+        self.copier.start()
+
+    def get(self, path):
+        """the path of a copy of the file to read instead of the original (or the
+        original path, if it isn't cached); the copy is in use (and can't be
+        evicted) until released"""
+        if not isStageable(path):
+            return path
+        try:
+            st = os.stat(path)
+        except OSError:
+            return path
+        if not stat.S_ISREG(st.st_mode):
+            return path
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                if (entry.mtime, entry.size) == (st.st_mtime, st.st_size):
+                    self.hits += 1
+                    self.bytes_saved += entry.size
+                    entry.users += 1
+                    # (most recently used last)
+                    del self.entries[path]
+                    self.entries[path] = entry
+                    return entry.path
+                if entry.users > 0:
+                    # the file has changed since we copied it, but running stages
+                    # are still using the copy (and will release it by the path):
+                    # read the original until they're done with it
+                    self.misses += 1
+                    return path
+                # the file has changed since we copied it
+                del self.entries[path]
+                self.discard(entry)
+            self.misses += 1
+            if path in self.pending:
+                return path
+            key = (path, st.st_mtime, st.st_size)
+            if key not in self.requests and len(self.requests) >= MAX_TRACKED_REQUESTS:
+                self.requests.popitem(last=False)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if self.requests[key] < 2 or not self.makeRoom(st.st_size):
+                return path
+            del self.requests[key]
+            self.pending[path] = st.st_size
+            self.used += st.st_size
+        self.queue.put((path, st))
+        return path
+
+    def copyFiles(self):
+        while True:
+            path, st = self.queue.get()
+            try:
+                self.copyFile(path, st)
+            finally:
+                self.queue.task_done()
+
+    def copyFile(self, path, st):
+        """copy the file (as it was when stat'ed) into the cache; the copy
+        only appears under its name in the cache once it's complete"""
+        copy = os.path.join(self.dir, hashlib.md5(path).hexdigest() + "_" + os.path.basename(path))
+        tmp = copy + ".tmp"
+        try:
+            if self.removed:
+                return self.copied(path, None)
+            shutil.copyfile(path, tmp)
+            now = os.stat(path)
+            if (now.st_mtime, now.st_size) != (st.st_mtime, st.st_size):
+                logger.info("%s changed while it was copied to the input cache", path)
+                os.remove(tmp)
+                return self.copied(path, None)
+            os.rename(tmp, copy)
+        except (IOError, OSError):
+            if not self.removed:
+                logger.exception("Couldn't copy %s to the input cache", path)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return self.copied(path, None)
+        self.copied(path, CacheEntry(st.st_mtime, st.st_size, copy))
+
+    def copied(self, path, entry):
+        """the copy of the file at path is done (entry is None if it failed)"""
+        with self.lock:
+            size = self.pending.pop(path)
+            if entry is None:
+                self.used -= size
+            else:
+                self.entries[path] = entry
+
+    def wait(self):
+        """wait for the copies being made to be done"""
+        self.queue.join()
+
+    def release(self, path):
+        """the stage which got the (copy of the) file at path is done with it"""
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry.users > 0:
+                entry.users -= 1
+
+    def makeRoom(self, size):
+        """evict the least recently used copies not in use until size bytes fit
+        into the budget; returns False if they can't"""
+        if size > self.budget:
+            return False
+        for path, entry in list(self.entries.items()):
+            if self.used + size <= self.budget:
+                break
+            if entry.users == 0:
+                del self.entries[path]
+                self.discard(entry)
+        return self.used + size <= self.budget
+
+    def discard(self, entry):
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+        self.used -= entry.size
+
+    def summary(self):
+        return ("input cache: %d hits, %d misses, %.1fM read from the cache rather than the shared filesystem, %.1fM of %.1fM used"
+                % (self.hits, self.misses, self.bytes_saved / 1024.0 ** 2,
+                   self.used / 1024.0 ** 2, self.budget / 1024.0 ** 2))
+
+    def remove(self):
+        # (copies still being made are abandoned)
+        self.removed = True
+        shutil.rmtree(self.dir, ignore_errors=True)
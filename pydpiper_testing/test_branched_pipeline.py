@@ -18,7 +18,7 @@ class TestBranchedPipeline():
         self.p.addStage(CmdStage(["subcommand-5-6", InputFile(startFileB), OutputFile(generateFile(6))]))
         self.p.addStage(CmdStage(["subcommand-5-7", InputFile(startFileB), OutputFile(generateFile(7))]))
         self.p.initialize()
-        nx.write_dot(self.p.G, "branched-test-pipeline.dot")
+        nx.write_dot(self.p.exportGraph(), "branched-test-pipeline.dot")
         
     def test_graph_heads(self):
         """make sure that both graph heads can run without predecessors"""
@@ -48,7 +48,7 @@ class TestBranchedPipeline():
         s = self.p.getRunnableStageIndex()
         assert s == 0
         self.p.setStageFailed(s)
-        assert self.p.stages[s].status == "failed"
+        assert self.p.getStageStatus(s) == "failed"
         s = self.p.getRunnableStageIndex()
         assert s == 3
         assert self.p.continueLoop() == True
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+from pydpiper.cpu_affinity import *
+import subprocess
+
+class TestCPUAllocator():
+    def setup_method(self, method):
+        self.allocator = CPUAllocator(range(8))
+
+    def test_disjoint_cpus(self):
+        """make sure that the CPUs handed out don't overlap"""
+        a = self.allocator.allocate(4)
+        b = self.allocator.allocate(3)
+        assert a == [0, 1, 2, 3] and b == [4, 5, 6]
+        assert self.allocator.allocate(2) is None
+        self.allocator.release(a)
+        assert self.allocator.allocate(2) == [0, 1]
+
+    def test_thread_counts(self):
+        env = threadCountEnv(4)
+        assert env["OMP_NUM_THREADS"] == "4"
+        assert env["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] == "4"
+
+class TestAffinity():
+    def test_roundtrip(self):
+        """make sure that the affinity of this process can be read and (re)set"""
+        cpus = getAffinity()
+        if cpus is None:
+            return
+        assert len(cpus) > 0
+        setAffinity(cpus)
+        assert getAffinity() == cpus
+
+    def test_pinned_command(self):
+        """make sure that a command run with taskset is restricted to the given CPUs"""
+        taskset = tasksetPath()
+        cpus = getAffinity()
+        if taskset is None or cpus is None:
+            return
+        cpu = min(cpus)
+        out = subprocess.check_output(pinnedArgv(taskset, [cpu], ["grep", "Cpus_allowed_list", "/proc/self/status"]))
+        assert out.split()[-1] == str(cpu)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline_executor import *
+import os
+import tempfile
+import shutil
+
+def step(index, argv, logfile):
+    return { "index" : index, "command" : " ".join(argv), "argv" : argv,
+             "logfile" : logfile, "mem" : 1.0, "procs" : 1, "env" : {}, "inputs" : [], "outputs" : [] }
+
+def runToCompletion(child):
+    while True:
+        result = child.poll()
+        if result is not None:
+            return result
+        time.sleep(0.01)
+
+class TestChildProcess():
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, "stage.log")
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.dir)
+
+    def test_steps_run_in_order(self):
+        """make sure that the steps of a unit are run one after the other"""
+        child = ChildProcess({ "index" : 0, "mem" : 2.0, "procs" : 1,
+                               "steps" : [step(0, ["true"], self.log),
+                                          step(1, ["false"], self.log)] })
+        child.startNextStep()
+        ret, stats = runToCompletion(child)
+        assert ret == 0 and child.index == 0
+        assert stats["walltime"] >= 0 and "maxrss" in stats
+        child.startNextStep()
+        ret, _ = runToCompletion(child)
+        assert ret == 1 and child.index == 1
+        assert child.steps == []
+
+    def test_kept_intermediates(self):
+        """make sure that a step whose outputs are kept in scratch space for the
+        rest of its chain says so (so the server doesn't journal it)"""
+        scratch = os.path.join(self.dir, "scratch")
+        os.mkdir(scratch)
+        src, mid, out = [os.path.join(self.dir, f) for f in ("src.mnc", "mid.mnc", "out.mnc")]
+        open(src, 'w').close()
+        first = step(0, ["cp", src, mid], self.log)
+        first.update(inputs=[src], outputs=[mid])
+        second = step(1, ["cp", mid, out], self.log)
+        second.update(inputs=[mid], outputs=[out])
+        child = ChildProcess({ "index" : 0, "mem" : 1.0, "procs" : 1, "steps" : [first, second] },
+                             scratch_dir=scratch, keep_intermediates_local=True)
+        child.startNextStep()
+        ret, stats = runToCompletion(child)
+        assert ret == 0 and stats["outputs_kept_local"]
+        assert not os.path.exists(mid)
+        child.startNextStep()
+        ret, stats = runToCompletion(child)
+        assert ret == 0 and "outputs_kept_local" not in stats
+        assert os.path.exists(out)
+        child.finishUnit()
+
+    def test_missing_command(self):
+        """make sure that a command which can't be started raises an exception"""
+        child = ChildProcess({ "index" : 3, "mem" : 1.0, "procs" : 1,
+                               "steps" : [step(3, [os.path.join(self.dir, "missing")], self.log)] })
+        try:
+            child.startNextStep()
+        except OSError:
+            assert child.index == 3 and child.process is None
+        else:
+            assert False
+
+class TestWakeupPipe():
+    def test_set_and_clear(self):
+        e = WakeupPipe()
+        e.set()
+        e.set()
+        start = time.time()
+        e.wait(5.0)
+        assert time.time() - start < 1.0
+        e.clear()
+        start = time.time()
+        e.wait(0.1)
+        assert time.time() - start >= 0.1
+
+class FakeServer():
+    def __init__(self):
+        self.calls = []
+    def setStagesTerminated(self, clientURI, results):
+        time.sleep(0.1)
+        self.calls.append(("setStagesTerminated", [i for i, _, _ in results]))
+    def unregisterClient(self, clientURI):
+        self.calls.append(("unregisterClient", clientURI))
+
+class TestCompletionReporting():
+    def setup_method(self, method):
+        parser = ArgParser()
+        addExecutorArgumentGroup(parser)
+        options = parser.parse_args([])
+        options.pipeline_name = "test"
+        self.executor = pipelineExecutor(options)
+        self.executor.e = WakeupPipe()
+        self.executor.setClientURI("executor")
+        self.server = FakeServer()
+        self.executor.setProxyForServer(self.server)
+        self.executor.registeredWithServer()
+
+    def test_reports_before_unregistering(self):
+        """make sure that all completions are reported before unregistering, and none after"""
+        self.executor.startReporting()
+        self.executor.notifyStageTerminated(1, 0, {})
+        time.sleep(0.01)
+        self.executor.notifyStageTerminated(2, 0, {})
+        self.executor.unregister_with_server()
+        assert self.server.calls[-1] == ("unregisterClient", "executor")
+        reported = [i for call, args in self.server.calls[:-1] for i in args]
+        assert sorted(reported) == [1, 2]
+        assert self.executor.reporter is None
+
+class FakeUnit():
+    # (a ChildProcess running a single step, whose command has the given pid)
+    def __init__(self, pid, started):
+        self.process = FakeProcess(pid)
+        self.stage = pid
+        self.index = pid
+        self.started = started
+        self.mem = 1.0
+        self.procs = 1
+        self.cpus = None
+        self.suspended = False
+        self.steps = []
+        self.results = []
+        self.local = []
+    def poll(self):
+        # (a suspended unit's command doesn't exit)
+        return None if self.suspended else (0, {})
+    def finishUnit(self):
+        pass
+
+class FakeProcess():
+    def __init__(self, pid):
+        self.pid = pid
+
+class TestMemoryPressure():
+    def setup_method(self, method):
+        parser = ArgParser()
+        addExecutorArgumentGroup(parser)
+        options = parser.parse_args(["--mem", "16", "--measured-memory-admission", "--suspend-on-memory-pressure"])
+        options.pipeline_name = "test"
+        self.executor = pipelineExecutor(options)
+        # four units using 5G each, started a while ago
+        self.executor.runningChildren = [FakeUnit(pid, time.time() - 1000 + pid) for pid in range(1, 5)]
+        self.executor.runningMem = 4.0
+        self.rss = dict((pid, 5.0) for pid in range(1, 5))
+        self.signals = []
+        self.processTrees = rm.processTrees
+        rm.processTrees = lambda roots: dict((pid, ([pid], self.rss[pid])) for pid in roots)
+        self.executor.signalChild = lambda child, signum, trees=None: self.signals.append((child.index, signum))
+
+    def teardown_method(self, method):
+        rm.processTrees = self.processTrees
+
+    def test_one_suspension_per_interval(self):
+        """make sure that waking up repeatedly (e.g., by the SIGCHLD of a stopped child)
+        doesn't suspend one unit after another while memory use is still measured
+        as it was before the first suspension, nor resume them right away"""
+        for _ in range(5):
+            assert self.executor.memFree() == 0
+        assert self.signals == [(4, signal.SIGSTOP)]
+        # the suspended unit's memory doesn't count against the running ones
+        self.executor.last_memory_action -= MEMORY_PRESSURE_INTERVAL
+        self.executor.memFree()
+        assert self.signals == [(4, signal.SIGSTOP)]
+        # but if they grow anyway, another one is suspended
+        self.rss[3] = 7.0
+        self.executor.memFree()
+        assert self.signals == [(4, signal.SIGSTOP), (3, signal.SIGSTOP)]
+
+    def test_resume_when_there_is_room(self):
+        """make sure that a suspended unit is resumed once it fits along with the running ones"""
+        self.executor.memFree()
+        self.rss[1] = self.rss[2] = 1.0
+        self.executor.memFree()
+        assert self.signals == [(4, signal.SIGSTOP)]
+        self.executor.last_memory_action -= MEMORY_PRESSURE_INTERVAL
+        self.executor.memFree()
+        assert self.signals == [(4, signal.SIGSTOP), (4, signal.SIGCONT)]
+        assert not any(c.suspended for c in self.executor.runningChildren)
+
+    def test_resume_when_alone(self):
+        """make sure that a suspended unit is resumed once no others are running,
+        even if it doesn't fit under the limit"""
+        self.executor.memFree()
+        self.rss[4] = 16.0
+        self.executor.runningChildren = [c for c in self.executor.runningChildren if c.index == 4]
+        self.executor.last_memory_action -= MEMORY_PRESSURE_INTERVAL
+        self.executor.memFree()
+        assert self.signals == [(4, signal.SIGSTOP), (4, signal.SIGCONT)]
+        assert not self.executor.runningChildren[0].suspended
+
+    def test_drain_resumes_suspended_units(self):
+        """make sure that units suspended when the executor stops taking on
+        stages are resumed, so it doesn't wait for them forever"""
+        unit = FakeUnit(4, time.time() - 1000)
+        unit.suspended = True
+        self.executor.runningChildren = [unit]
+        self.executor.runningMem = 1.0
+        self.executor.runningProcs = 1
+        self.executor.e = WakeupPipe()
+        self.executor.setProxyForServer(FakeServer())
+        def signalChild(child, signum, trees=None):
+            self.signals.append((child.index, signum))
+            # (as the SIGCHLD of the resumed command exiting would)
+            self.executor.e.set()
+        self.executor.signalChild = signalChild
+        self.executor.completeAndExitChildren()
+        assert self.signals == [(4, signal.SIGCONT)]
+        assert self.executor.runningChildren == []
+
+class TestChildStops():
+    def test_stopped_child_isnt_reaped(self):
+        """make sure that a child which is stopped (rather than exited) isn't reaped"""
+        child = ChildProcess({ "index" : 0, "mem" : 1.0, "procs" : 1,
+                               "steps" : [step(0, ["sleep", "10"], os.devnull)] })
+        child.startNextStep()
+        os.kill(child.process.pid, signal.SIGSTOP)
+        while rm.processState(child.process.pid) != "T":
+            time.sleep(0.01)
+        assert child.poll() is None
+        os.kill(child.process.pid, signal.SIGKILL)
+        ret, _ = runToCompletion(child)
+        assert ret == -signal.SIGKILL
+
+class TestScratchDir():
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.dir)
+
+    def executor(self, scratch_dir):
+        parser = ArgParser()
+        addExecutorArgumentGroup(parser)
+        options = parser.parse_args(["--scratch-dir", scratch_dir])
+        options.pipeline_name = "test"
+        return pipelineExecutor(options)
+
+    def test_missing_dir_created(self):
+        """make sure that a missing scratch directory is created (and left empty)"""
+        scratch = os.path.join(self.dir, "a", "scratch")
+        self.executor(scratch).checkScratchDir()
+        assert os.path.isdir(scratch)
+        assert os.listdir(scratch) == []
+
+    def test_unusable_dir(self):
+        """make sure that the executor exits if the scratch directory can't be created"""
+        blocker = os.path.join(self.dir, "file")
+        open(blocker, "w").close()
+        try:
+            self.executor(os.path.join(blocker, "scratch")).checkScratchDir()
+        except SystemExit as e:
+            assert e.code == 1
+        else:
+            assert False
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+from pydpiper.journal import *
+import pydpiper.journal as journal
+import os
+import tempfile
+import shutil
+
+class TestFinishedStagesJournal():
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "test_finished_stages")
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.dir)
+
+    def test_roundtrip(self):
+        """make sure that recorded stages are read back on restart"""
+        j = FinishedStagesJournal(self.path)
+        for i in range(10):
+            j.record(i, "digest%d" % i)
+        j.close()
+        assert FinishedStagesJournal(self.path).read() == frozenset(["digest%d" % i for i in range(10)])
+
+    def test_group_commit(self):
+        """make sure that entries are only written once enough have accumulated"""
+        j = FinishedStagesJournal(self.path, flush_count=3, flush_interval=1000)
+        j.record(0, "a")
+        j.record(1, "b")
+        assert not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        j.record(2, "c")
+        assert len(open(self.path).readlines()) == 3
+
+    def test_no_duplicates(self):
+        """make sure that stages read from the journal aren't recorded again,
+        and that their digests are dropped once the journal is compacted"""
+        j = FinishedStagesJournal(self.path)
+        j.record(0, "a")
+        j.close()
+        j = FinishedStagesJournal(self.path)
+        j.read()
+        j.record(0, "a")
+        j.record(1, "b")
+        j.flush()
+        assert len(open(self.path).readlines()) == 2
+        j.compact([(0, "a"), (1, "b")])
+        assert j.previous == frozenset()
+        j.close()
+
+    def test_corrupt_and_legacy_entries(self):
+        """make sure that corrupt lines are skipped and old-style lines accepted"""
+        with open(self.path, 'w') as f:
+            f.write(formatEntry(0, "good"))
+            f.write("1,bad,00000000\n")
+            f.write("2,-12345\n")
+            f.write("3,torn")
+        j = FinishedStagesJournal(self.path)
+        assert j.read() == frozenset(["good", "-12345", "torn"])
+        j.record(4, "after")
+        j.close()
+        assert "after" in FinishedStagesJournal(self.path).read()
+
+    def test_compaction(self):
+        """make sure that compaction only happens with many stale entries"""
+        j = FinishedStagesJournal(self.path)
+        for i in range(10):
+            j.record(i, "digest%d" % i)
+        j.close()
+        j = FinishedStagesJournal(self.path)
+        j.read()
+        assert not j.compact([(0, "digest0")])
+        journal.MIN_STALE_ENTRIES_TO_COMPACT = 1
+        try:
+            assert j.compact([(0, "digest0")])
+        finally:
+            journal.MIN_STALE_ENTRIES_TO_COMPACT = 1000
+        assert FinishedStagesJournal(self.path).read() == frozenset(["digest0"])
+
+    def test_deferred_flush(self):
+        """make sure that a batch of entries recorded without flushing is
+        written by a single maybeFlush"""
+        j = FinishedStagesJournal(self.path, flush_count=3, flush_interval=1000)
+        for i in range(5):
+            j.record(i, "digest%d" % i, flush=False)
+        assert not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        j.maybeFlush()
+        assert len(open(self.path).readlines()) == 5
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline_report import *
+import os
+import tempfile
+import shutil
+
+def record(index, name, start, walltime, predecessors=[], executor="A", procs=1, run=2.0):
+    return { "index" : index, "name" : name, "start" : start, "walltime" : walltime,
+             "predecessors" : predecessors, "executor" : executor, "procs" : procs,
+             "returncode" : 0, "run" : run }
+
+class TestPipelineReport():
+    def setup_method(self, method):
+        # 0 -> 2, 1 -> 2, where 1 is the straggler; 3 is independent
+        self.records = [# a previous run of the pipeline
+                        record(4, "mincblur -fwhm 0.2 img_4", -100.0, 1.0, run=1.0),
+                        record(0, "mincblur -fwhm 0.1 img_0", 0.0, 1.0),
+                        record(1, "mincANTS img_1", 0.0, 5.0, executor="B", procs=2),
+                        record(2, "mincaverage", 6.0, 2.0, predecessors=[0, 1]),
+                        record(3, "mincblur -fwhm 0.1 img_3", 1.0, 3.0, executor="C"),
+                        # an earlier, failed attempt at stage 2
+                        record(2, "mincaverage", 5.0, 0.5, predecessors=[0, 1])]
+        self.report = summarize(self.records)
+
+    def test_critical_path(self):
+        """make sure that the critical path follows the predecessor which finished last"""
+        assert [r["index"] for r in self.report["critical_path"]] == [1, 2]
+        assert self.report["makespan"] == 8.0
+        assert self.report["critical_share"] == 7.0 / 8.0
+
+    def test_utilisation(self):
+        """make sure that the processors in use are tracked over time"""
+        assert self.report["peak_procs"] == 3
+        assert self.report["utilisation"] == [(0.0, 3), (1.0, 3), (4.0, 2), (5.0, 0), (6.0, 1), (8.0, 0)]
+        assert self.report["mean_procs"] == 16.0 / 8.0
+
+    def test_lanes_and_types(self):
+        """make sure that stages of an executor which don't overlap share a lane"""
+        lanes = dict(self.report["lanes"])
+        assert [[r["index"] for r in lane] for lane in lanes["A"]] == [[0, 2]]
+        assert [t["name"] for t in self.report["stage_types"]] == ["mincANTS", "mincblur", "mincaverage"]
+        ants, blur, _ = self.report["stage_types"]
+        assert ants["cluster_seconds"] == 10.0 and ants["mean_walltime"] == 5.0
+        assert blur["count"] == 2 and blur["mean_walltime"] == 2.0 and blur["max_walltime"] == 3.0
+
+    def test_latest_run(self):
+        """make sure that only the most recent run is reported, unless the runs can't be told apart"""
+        assert 4 not in self.report["stages"] and self.report["run"] == 2.0
+        for r in self.records:
+            del r["run"]
+        report = summarize(self.records)
+        assert 4 in report["stages"] and report["run"] is None
+
+    def test_html(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, "report.html")
+            writeHTML(self.report, path)
+            assert "mincANTS" in open(path).read()
+        finally:
+            shutil.rmtree(d)
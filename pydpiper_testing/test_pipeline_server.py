@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+import threading
+import tempfile
+import time
+import shutil
+import os
+
+def generateFile(i):
+    return("filename_" + str(i) + ".mnc")
+
+class BlockingClient():
+    """stands in for an ExecClient whose executor is slow to connect to:
+    waking it up blocks until the test releases it"""
+    def __init__(self, expected_calls):
+        self.wake_up_pending = False
+        self.calls = 0
+        self.returned = 0
+        self.expected_calls = expected_calls
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.done = threading.Event()
+
+    def wakeUp(self):
+        self.calls += 1
+        self.entered.set()
+        self.release.wait(10)
+        self.returned += 1
+        if self.returned == self.expected_calls:
+            self.done.set()
+
+class TestWakeUpNotifier():
+    def test_slow_executor(self):
+        """make sure that waking up a slow executor doesn't block the caller,
+        and that an executor is queued at most once"""
+        client = BlockingClient(expected_calls=2)
+        notifier = WakeUpNotifier()
+        notifier.notify(client)
+        assert client.entered.wait(10)
+        # the notifier's thread is stuck waking the executor up, but further
+        # notifications still return (and only queue the executor once)
+        notifier.notify(client)
+        notifier.notify(client)
+        assert client.calls == 1
+        assert client.wake_up_pending
+        assert notifier.queue.qsize() == 1
+        client.release.set()
+        assert client.done.wait(10)
+        assert client.calls == 2
+        assert not client.wake_up_pending
+        assert notifier.queue.qsize() == 0
+
+class TestUnknownClient():
+    def test_no_stages_for_unknown_client(self):
+        """make sure that an unregistered executor isn't handed (and doesn't lose) stages"""
+        p = Pipeline()
+        p.addStage(CmdStage(["somecommand", InputFile(generateFile(0)), OutputFile(generateFile(1))]))
+        p.initialize()
+        assert p.getCommands("stranger", 8, 8) == ("wait", [])
+        assert 0 in p.runnable
+
+class TestTerminatedBatch():
+    def test_error_doesnt_drop_batch(self):
+        """make sure that an error with one stage of a batch of terminated
+        stages doesn't keep the others from being finished"""
+        p = Pipeline()
+        p.addStage(CmdStage(["somecommand", InputFile(generateFile(0)), OutputFile(generateFile(1))]))
+        p.addStage(CmdStage(["somecommand", InputFile(generateFile(2)), OutputFile(generateFile(3))]))
+        p.initialize()
+        p.registerClient("client", 8)
+        cmd, units = p.getCommands("client", 2, 1)
+        assert len(units) == 1
+        started = units[0]["steps"][0]["index"]
+        other = 1 - started
+        # (the other stage was never handed out, so finishing it fails)
+        p.setStagesTerminated("client", [(other, 0, None), (started, 0, None)])
+        assert p.state.isFinished(started)
+        assert not p.state.isFinished(other)
+
+    def test_kept_local_not_journaled(self):
+        """make sure that stages whose outputs were kept in scratch space aren't journaled"""
+        d = tempfile.mkdtemp()
+        try:
+            p = Pipeline()
+            p.addStage(CmdStage(["somecommand", InputFile(generateFile(0)), OutputFile(generateFile(1))]))
+            p.addStage(CmdStage(["somecommand", InputFile(generateFile(1)), OutputFile(generateFile(2))]))
+            p.initialize()
+            p.journal = FinishedStagesJournal(os.path.join(d, "finished_stages"))
+            p.registerClient("client", 8)
+            p.fuseStageChains()
+            cmd, units = p.getCommands("client", 8, 8)
+            p.setStagesTerminated("client", [(0, 0, { "outputs_kept_local" : True }), (1, 0, {})])
+            p.journal.close()
+            assert p.allStagesCompleted()
+            assert FinishedStagesJournal(p.journal.path).read() == frozenset([p.stages[1].getHash()])
+        finally:
+            shutil.rmtree(d)
+
+class TestReadiness():
+    def setup_method(self, method):
+        # stage 2 reads the outputs of both stages 0 and 1
+        self.p = Pipeline()
+        self.p.addStage(CmdStage(["somecommand", InputFile(generateFile(0)), OutputFile(generateFile(1))]))
+        self.p.addStage(CmdStage(["somecommand", InputFile(generateFile(2)), OutputFile(generateFile(3))]))
+        self.p.addStage(CmdStage(["somecommand", InputFile(generateFile(1)), InputFile(generateFile(3)),
+                                  OutputFile(generateFile(4))]))
+        self.p.initialize()
+        self.p.registerClient("client", 8)
+        cmd, units = self.p.getCommands("client", 8, 8)
+        assert sorted(unit["index"] for unit in units) == [0, 1]
+
+    def test_last_predecessor(self):
+        """make sure that a stage only becomes runnable once its last predecessor finishes"""
+        assert self.p.unfinished_predecessors[2] == 2
+        self.p.setStageFinished(0, "client")
+        assert self.p.unfinished_predecessors[2] == 1
+        assert 2 not in self.p.runnable
+        self.p.setStageFinished(1, "client")
+        assert self.p.unfinished_predecessors[2] == 0
+        assert 2 in self.p.runnable
+
+    def test_duplicate_finish(self):
+        """make sure that a stage finishing twice (e.g., after being presumed lost)
+        only counts once towards its successors"""
+        self.p.setStageFinished(0, "client")
+        self.p.setStageFinished(0, "client")
+        self.p.setStagesTerminated("client", [(0, 0, None)])
+        assert self.p.unfinished_predecessors[2] == 1
+        assert 2 not in self.p.runnable
+        self.p.setStageFinished(1, "client")
+        assert 2 in self.p.runnable
+
+class TestRestart():
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "finished_stages")
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.dir)
+
+    def pipeline(self):
+        p = Pipeline()
+        p.addStage(CmdStage(["somecommand", InputFile(generateFile(0)), OutputFile(generateFile(1))]))
+        p.addStage(CmdStage(["somecommand", InputFile(generateFile(1)), OutputFile(generateFile(2))]))
+        p.initialize()
+        p.journal = FinishedStagesJournal(self.path)
+        return p
+
+    def test_legacy_journal(self):
+        """make sure that a finished stages file written by older versions (with
+        the builtin hash of each stage) is recognized on restart, and that the
+        stages are journaled again with their new digests"""
+        p = self.pipeline()
+        with open(self.path, 'w') as f:
+            f.write("0,%d\n" % p.stages[0].getLegacyHash())
+        p.skip_completed_stages()
+        p.journal.close()
+        assert p.state.isFinished(0) and not p.state.isFinished(1)
+        assert 1 in p.runnable
+        assert p.stages[0].getHash() in FinishedStagesJournal(self.path).read()
+
+class TestRetries():
+    def setup_method(self, method):
+        # a chain of three stages, and a stage on its own
+        self.p = Pipeline()
+        for i in range(3):
+            self.p.addStage(CmdStage(["somecommand", InputFile(generateFile(i)), OutputFile(generateFile(i + 1))]))
+        self.p.addStage(CmdStage(["othercommand", InputFile(generateFile(10)), OutputFile(generateFile(11))]))
+        self.p.initialize()
+        self.p.max_stage_retries = 2
+        self.p.stage_retry_interval = 10.0
+        self.p.registerClient("client", 8)
+
+    def run(self, *indices):
+        """hand the given stages (and whatever else is runnable) out to the client"""
+        cmd, units = self.p.getCommands("client", 8, 8)
+        assert set(indices) <= set(unit["index"] for unit in units)
+
+    def fail(self, i):
+        """fail stage i; returns bounds of the delay after which it's retried"""
+        before = time.time()
+        self.p.setStageFailed(i, "client")
+        after = time.time()
+        due = [t for t, j in self.p.retry_heap if j == i][0]
+        return (due - before, due - after)
+
+    def makeDue(self):
+        self.p.retry_heap = [(0, i) for _, i in self.p.retry_heap]
+
+    def test_delayed_and_doubling(self):
+        """make sure that a failed stage only becomes runnable after a delay,
+        which doubles with every failure"""
+        self.run(0)
+        longest, shortest = self.fail(0)
+        assert shortest <= 10.0 <= longest
+        self.p.releaseDelayedRetries()
+        assert 0 not in self.p.runnable
+        self.makeDue()
+        self.p.releaseDelayedRetries()
+        assert 0 in self.p.runnable and not self.p.retry_heap
+        self.run(0)
+        longest, shortest = self.fail(0)
+        assert shortest <= 20.0 <= longest
+
+    def test_retry_limit(self):
+        """make sure that a stage failing more often than it may be retried is
+        given up on, along with the stages depending on it"""
+        for _ in range(self.p.max_stage_retries):
+            self.run(0)
+            self.fail(0)
+            self.makeDue()
+            self.p.releaseDelayedRetries()
+        self.run(0)
+        self.p.setStageFailed(0, "client")
+        assert not self.p.retry_heap
+        assert self.p.state.getStatus(0) == "failed"
+        assert self.p.state.processedStages() == [0, 1, 2]
+
+    def test_no_shutdown_while_retrying(self):
+        """make sure that the server doesn't shut down while a stage is waiting to be retried"""
+        self.run(0, 3)
+        self.p.max_stage_retries = 0
+        self.p.setStageFailed(3, "client")
+        self.p.max_stage_retries = 2
+        self.fail(0)
+        assert self.p.runnable.empty() and self.p.state.count("running") == 0
+        assert self.p.continueLoop()
+        self.p.retry_heap = []
+        assert not self.p.continueLoop()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+from pydpiper.resource_model import *
+from pydpiper.pipeline import Pipeline, CmdStage, InputFile, OutputFile
+import os
+import tempfile
+import shutil
+import subprocess
+
+def generateFile(i):
+    return("filename_" + str(i) + ".mnc")
+
+def observation(name, input_bytes, maxrss, returncode=0):
+    return { "name" : name, "input_bytes" : input_bytes, "maxrss" : maxrss,
+             "walltime" : 1.0, "returncode" : returncode }
+
+def programObservation(program, name, input_bytes, maxrss):
+    r = observation(name, input_bytes, maxrss)
+    r["program"] = program
+    return r
+
+class TestResourceModel():
+    def setup_method(self, method):
+        records = [observation("mincANTS", 100, 4.0),
+                   observation("mincANTS", 200, 7.0),
+                   observation("mincANTS", 300, 10.0),
+                   observation("mincANTS", 400, 30.0, returncode=-9),
+                   observation("mincmath", 100, 0.2),
+                   observation("mincmath", 100, 0.3)]
+        self.model = ResourceModel(records, margin=0.5)
+
+    def test_linear_fit(self):
+        """make sure that memory is predicted from the input size, with a margin"""
+        assert abs(self.model.predictMem("mincANTS", 250, 2.0) - 12.75) < 1e-9
+
+    def test_capped_at_largest_observed(self):
+        """make sure that predictions don't extrapolate beyond the largest peak memory observed"""
+        assert abs(self.model.predictMem("mincANTS", 10 ** 6, 2.0) - 15.0) < 1e-9
+
+    def test_keyed_by_program(self):
+        """make sure that stages whose names differ per subject are modelled together"""
+        model = ResourceModel([programObservation("mincblur", "mincblur 0.056 img_%d" % i, 100 * i, 1.0 * i)
+                               for i in range(1, 4)], margin=0)
+        assert abs(model.predictMem("mincblur", 250, 9.0) - 2.5) < 1e-9
+        # (older records only have the name)
+        assert programOf(observation("mincblur 0.056 img_1", 100, 1.0)) == "mincblur"
+
+    def test_fallback(self):
+        """make sure that programs with too few observations keep their defaults"""
+        assert self.model.predictMem("mincmath", 100, 2.0) == 2.0
+        assert self.model.predictMem("xfmconcat", 100, 2.0) == 2.0
+
+class TestPredictedMemory():
+    def test_chain_gets_largest_prediction(self):
+        """make sure that the head of a fused chain asks for the memory its hungriest step is predicted to need"""
+        p = Pipeline()
+        p.addStage(CmdStage(["mincblur", InputFile(generateFile(0)), OutputFile(generateFile(1))]))
+        p.addStage(CmdStage(["mincANTS", InputFile(generateFile(1)), OutputFile(generateFile(2))]))
+        p.initialize()
+        p.fuseStageChains()
+        p.setResourceModel(ResourceModel([{ "program" : "mincANTS", "name" : "mincANTS", "input_bytes" : 0,
+                                            "maxrss" : 10.0, "returncode" : 0 }] * 3, margin=0.2))
+        assert abs(p.state.mem[0] - 12.0) < 1e-9
+
+    def test_capped_by_executors(self):
+        """make sure that no stage is predicted to need more memory than the largest executor has"""
+        p = Pipeline()
+        p.addStage(CmdStage(["mincANTS", InputFile(generateFile(0)), OutputFile(generateFile(1))]))
+        p.initialize()
+        p.setResourceModel(ResourceModel([{ "program" : "mincANTS", "name" : "mincANTS", "input_bytes" : 0,
+                                            "maxrss" : 10.0, "returncode" : 0 }] * 3, margin=0.2))
+        p.registerClient("client", 8)
+        assert p.state.mem[0] == 8
+        assert p.continueLoop()
+
+    def test_registration_keeps_queue(self):
+        """make sure that re-indexing the runnable stages when an executor
+        registers keeps their order and the time they became runnable"""
+        p = Pipeline()
+        for i in range(3):
+            p.addStage(CmdStage(["mincANTS", InputFile(generateFile(10 * i)), OutputFile(generateFile(10 * i + 1))]))
+        p.initialize()
+        p.setResourceModel(ResourceModel([{ "program" : "mincANTS", "name" : "mincANTS", "input_bytes" : 0,
+                                            "maxrss" : 10.0, "returncode" : 0 }] * 3, margin=0.2))
+        since = list(p.runnable_since)
+        entries = dict(p.runnable.entries)
+        p.registerClient("client", 8)
+        assert list(p.runnable_since) == since
+        assert p.runnable.entries == entries
+        assert [p.runnable.get() for _ in range(3)] == [0, 1, 2]
+
+class TestStageStatsLog():
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "test_stage_stats")
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.dir)
+
+    def test_roundtrip(self):
+        """make sure that records are read back, skipping torn lines"""
+        log = StageStatsLog(self.path)
+        log.record(observation("mincblur", 10, 1.0))
+        log.close()
+        with open(self.path, 'a') as f:
+            f.write('{"name": "torn')
+        assert StageStatsLog(self.path).read() == [observation("mincblur", 10, 1.0)]
+
+class TestProcessAccounting():
+    def test_own_process(self):
+        """make sure that the state and I/O counters of a process are read from /proc"""
+        if not os.path.exists("/proc/self/io"):
+            return
+        assert processState(os.getpid()) == 'R'
+        io = processIO(os.getpid())
+        assert set(io.keys()) == set(PROC_IO_FIELDS)
+
+    def test_process_tree(self):
+        """make sure that a process's descendants and their memory are found"""
+        if not os.path.exists("/proc/self/stat"):
+            return
+        child = subprocess.Popen(["sleep", "10"])
+        try:
+            pids, rss = processTrees([os.getpid()])[os.getpid()]
+            assert os.getpid() in pids and child.pid in pids
+            assert rss > 0
+        finally:
+            child.kill()
+            child.wait()
+
+    def test_missing_process(self):
+        """make sure that processes which don't exist have no state or counters"""
+        assert processState(2 ** 30) is None
+        assert processIO(2 ** 30) == {}
+        assert processTrees([2 ** 30]) == {}
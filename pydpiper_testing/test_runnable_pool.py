@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+
+class TestRunnablePool():
+    def setup_method(self, method):
+        self.pool = RunnablePool()
+        self.pool.put(0, 12, 1)
+        self.pool.put(1, 2, 1)
+        self.pool.put(2, 2, 1)
+        self.pool.put(3, 4, 4)
+
+    def test_largest_fitting_stage(self):
+        """make sure that the largest stage that fits is handed out first"""
+        assert self.pool.get_fitting(16, 1) == 0
+        assert self.pool.get_fitting(16, 8) == 3
+        assert self.pool.get_fitting(16, 8) == 1
+
+    def test_nothing_fits(self):
+        """make sure that a stage that doesn't fit isn't removed from the pool"""
+        assert self.pool.get_fitting(1, 8) == None
+        assert self.pool.qsize() == 4
+
+    def test_small_stage_behind_big_one(self):
+        """make sure that a big stage doesn't block smaller ones"""
+        assert self.pool.get_fitting(4, 1) == 1
+        assert self.pool.min_mem() == 2
+
+    def test_fifo_order(self):
+        """make sure that get() hands out stages in the order they were added"""
+        assert [self.pool.get() for _ in range(4)] == [0, 1, 2, 3]
+        assert self.pool.empty()
+
+    def test_no_duplicates(self):
+        """make sure that a stage can't be in the pool twice"""
+        assert self.pool.put(1, 2, 1) == False
+        assert self.pool.qsize() == 4
+
+    def test_priority_order(self):
+        """make sure that higher-priority stages are handed out first"""
+        self.pool.put(4, 2, 1, priority=10)
+        assert self.pool.get_fitting(16, 8) == 4
+        assert self.pool.get() == 0
+
+    def test_fits(self):
+        """make sure that checking whether a stage fits doesn't remove it"""
+        assert self.pool.fits(2, 1)
+        assert not self.pool.fits(1, 8)
+        assert not self.pool.fits(8, 0)
+        assert self.pool.qsize() == 4
+
+    def test_local_stages_first(self):
+        """make sure that stages preferring the executor's host are handed out
+        first, and others only when none of those fit"""
+        self.pool.put(4, 2, 1, host="nodeA")
+        self.pool.put(5, 8, 1, host="nodeB")
+        assert self.pool.get_fitting(16, 8, host="nodeB") == 5
+        assert self.pool.get_fitting(16, 8, host="nodeA") == 4
+        assert self.pool.get_fitting(16, 8, host="nodeA") == 0
+        assert self.pool.qsize() == 3
+
+class TestLocality():
+    def test_departed_host_forgotten(self):
+        """make sure that stages aren't indexed by hosts which have no executors anymore"""
+        p = Pipeline()
+        p.addStage(CmdStage(["somecommand", InputFile("a.mnc"), OutputFile("b.mnc")]))
+        p.addStage(CmdStage(["somecommand", InputFile("b.mnc"), OutputFile("c.mnc")]))
+        p.initialize()
+        nodeA, nodeB = "PYRO:executor@nodeA:9999", "PYRO:executor@nodeB:9999"
+        p.registerClient(nodeA, 8)
+        p.registerClient(nodeB, 8)
+        cmd, units = p.getCommands(nodeA, 8, 8)
+        p.setStagesTerminated(nodeA, [(0, 0, None)])
+        assert p.runnable.local.keys() == [p.getHostID("nodeA")]
+        p.unregisterClient(nodeA)
+        assert p.runnable.local == {}
+        assert p.preferredHost(1) is None
+        assert p.getCommands(nodeB, 8, 8)[1][0]["index"] == 1
@@ -18,7 +18,7 @@ class TestSgeScript():
         self.p.addStage(CmdStage(["subcommand-5-6", InputFile(startFileB), OutputFile(generateFile(6))]))
         self.p.addStage(CmdStage(["subcommand-5-7", InputFile(startFileB), OutputFile(generateFile(7))]))
         self.p.initialize()
-        nx.write_dot(self.p.G, "branched-test-pipeline.dot")
+        nx.write_dot(self.p.exportGraph(), "branched-test-pipeline.dot")
     def test_flatten_pipeline_simple(self):
         p = Pipeline()
         p.addStage(CmdStage(["command"]))
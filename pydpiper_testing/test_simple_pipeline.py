@@ -14,7 +14,7 @@ class TestSimplePipeline():
         for i in range(2,100):
             self.p.addStage(CmdStage(["somecommand", InputFile(generateFile(i-1)), OutputFile(generateFile(i))]))
         self.p.initialize()
-        nx.write_dot(self.p.G, "simple-test-pipeline.dot")
+        nx.write_dot(self.p.exportGraph(), "simple-test-pipeline.dot")
 
     def test_graph_head(self):
         """make sure that it finds the graph head correctly"""
@@ -48,3 +48,17 @@ class TestSimplePipeline():
     def test_stage_already_exists(self):
         """make sure that if a stage already exists it is not recreated"""
         assert self.p.addStage(CmdStage(["somecommand", InputFile(generateFile(15)), OutputFile(generateFile(16))])) == None
+
+    def test_shared_paths(self):
+        """make sure that a file used by several stages is stored only once"""
+        assert self.p.stages[1].outputFiles[0] is self.p.stages[2].inputFiles[0]
+        assert self.p.stages[2].cmd[1] is self.p.stages[2].inputFiles[0]
+
+    def test_fused_chain(self):
+        """make sure that a fused chain is handed out as a single unit"""
+        self.p.fuseStageChains()
+        self.p.registerClient("client", 8)
+        cmd, units = self.p.getCommands("client", 8, 8)
+        assert cmd == "run_stage"
+        assert len(units) == 1
+        assert [step["index"] for step in units[0]["steps"]] == range(99)
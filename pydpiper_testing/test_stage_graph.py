@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+from pydpiper.stage_graph import *
+from pydpiper.pipeline import Pipeline, CmdStage, InputFile, OutputFile
+from array import array
+
+def graph(n, edges):
+    G = StageGraph()
+    for _ in range(n):
+        G.add_node()
+    G.set_edges(array('i', [s for s, _ in edges]), array('i', [t for _, t in edges]))
+    return G
+
+class TestCompressRows():
+    def test_offsets_and_indices(self):
+        """make sure that the columns of each row end up in its slice of the indices"""
+        offsets, indices = compressRows(4, array('i', [2, 0, 2, 0]), array('i', [1, 3, 3, 2]))
+        assert list(offsets) == [0, 2, 2, 4, 4]
+        assert list(indices) == [3, 2, 1, 3]
+
+    def test_no_edges(self):
+        offsets, indices = compressRows(3, array('i'), array('i'))
+        assert list(offsets) == [0, 0, 0, 0]
+        assert len(indices) == 0
+
+class TestStageGraph():
+    def setup_method(self, method):
+        # 0 -> 1 -> 3, 0 -> 2 -> 3, 4 on its own
+        self.G = graph(5, [(0, 1), (0, 2), (1, 3), (2, 3)])
+
+    def test_neighbours(self):
+        """make sure that successors and predecessors are found in both directions"""
+        assert sorted(self.G.successors(0)) == [1, 2]
+        assert sorted(self.G.predecessors(3)) == [1, 2]
+        assert self.G.successors(3) == [] and self.G.predecessors(0) == []
+        assert self.G.out_degree(0) == 2 and self.G.in_degree(3) == 2
+        assert self.G.number_of_nodes() == 5 and self.G.number_of_edges() == 4
+
+    def test_add_node(self):
+        """make sure that nodes added after the edges have no neighbours"""
+        assert self.G.add_node() == 5
+        assert self.G.successors(5) == [] and self.G.predecessors(5) == []
+        assert sorted(self.G.successors(0)) == [1, 2]
+
+    def test_descendants(self):
+        """make sure that every node reachable from a node is found exactly once"""
+        assert sorted(self.G.descendants(0)) == [1, 2, 3]
+        assert self.G.descendants(3) == []
+        assert self.G.descendants(4) == []
+
+    def test_topological_order(self):
+        """make sure that every node comes before its successors"""
+        order = self.G.topological_order()
+        assert sorted(order) == range(5)
+        position = dict((i, k) for k, i in enumerate(order))
+        for i in range(5):
+            for j in self.G.successors(i):
+                assert position[i] < position[j]
+
+    def test_cycle(self):
+        """make sure that a cycle is detected"""
+        G = graph(3, [(0, 1), (1, 2), (2, 1)])
+        try:
+            G.topological_order()
+        except Exception:
+            pass
+        else:
+            assert False
+
+class TestCreateEdges():
+    def test_no_self_edges(self):
+        """make sure that a stage reading and writing the same file doesn't depend on itself"""
+        p = Pipeline()
+        p.addStage(CmdStage(["make", OutputFile("b.mnc")]))
+        p.addStage(CmdStage(["update", InputFile("a.mnc"), InputFile("b.mnc"), OutputFile("a.mnc")]))
+        p.initialize()
+        assert p.G.predecessors(1) == [0]
+        assert p.G.successors(1) == []
+        assert p.G.number_of_edges() == 1
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+from pydpiper.stage_state import *
+
+class TestStageStates():
+    def setup_method(self, method):
+        self.states = StageStates()
+        for i in range(10):
+            self.states.add(2.0 + i, 1)
+
+    def test_status_counts(self):
+        """make sure that the number of stages per status is kept up to date"""
+        self.states.setStatus(3, "running")
+        self.states.setStatus(4, "running")
+        self.states.setStatus(3, "finished")
+        assert self.states.getStatus(3) == "finished"
+        assert self.states.isFinished(3) and self.states.isRunning(4)
+        assert self.states.count("running") == 1
+        assert self.states.count("finished") == 1
+        assert self.states.count(None) == 8
+
+    def test_processed_bitmap(self):
+        """make sure that a stage is only counted as processed once"""
+        assert self.states.setProcessed(9)
+        assert not self.states.setProcessed(9)
+        self.states.setProcessed(0)
+        assert self.states.number_processed == 2
+        assert self.states.processedStages() == [0, 9]
+
+    def test_resources(self):
+        assert self.states.mem[5] == 7.0
+        assert self.states.procs[5] == 1
+        assert len(self.states) == 10
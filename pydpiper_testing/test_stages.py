@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+
+def mincAtomsStage(cmd, name):
+    # (as the stages in atoms_and_modules/minc_atoms.py set them up)
+    s = CmdStage(None)
+    s.cmd = cmd
+    s.name = name
+    return s
+
+class TestStageCosts():
+    def test_cost_by_program(self):
+        """make sure that stage costs are looked up by program, not stage name"""
+        lsq12 = mincAtomsStage(["minctracc", "-clobber", "-lsq12", "src.mnc", "tgt.mnc", "out.xfm"],
+                               "minctracclsq12 ")
+        concat = mincAtomsStage(["xfmconcat", "-clobber", "a.xfm", "b.xfm", "ab.xfm"], "xfm-concat")
+        rotational = mincAtomsStage(["rotational_minctracc.py", "-t", "/tmp", "src.mnc", "tgt.mnc", "out.xfm"],
+                                    "rotational-minctracc")
+        blur = mincAtomsStage(["/usr/bin/mincblur", "-clobber", "-fwhm", "0.056", "img_1.mnc", "img_1"],
+                              "mincblur 0.056 img_1")
+        assert lsq12.getCost() == 10.0
+        assert concat.getCost() == 0.5
+        assert rotational.getCost() == 30.0
+        assert blur.getProgram() == "mincblur" and blur.getCost() == 1.0
+
+class TestStageIdentity():
+    def test_stable_digest(self):
+        """make sure that digests are deterministic and that strings (and
+        sequences) can't run into each other"""
+        assert stableDigest(["ab", "c"]) == stableDigest(["ab", "c"])
+        assert stableDigest(["ab", "c"]) != stableDigest(["a", "bc"])
+        assert stableDigest(["a"], ["b"]) != stableDigest(["a", "b"], [])
+        assert len(stableDigest(["a"])) == 64
+
+    def test_log_file_not_part_of_identity(self):
+        """make sure that changing only a stage's log file doesn't change its identity"""
+        s = CmdStage(["mincblur", InputFile("in.mnc"), OutputFile("out.mnc")])
+        h = s.getHash()
+        s.setLogFile("elsewhere.log")
+        assert s.getHash() == h
+        # (nor when the log file is an argument of the command)
+        a = CmdStage(["tool", InputFile("in.mnc"), "a.log"])
+        a.setLogFile("a.log")
+        b = CmdStage(["tool", InputFile("in.mnc"), "b.log"])
+        b.setLogFile("b.log")
+        assert a.getHash() == b.getHash()
+        assert a.getHash() != CmdStage(["tool", InputFile("other.mnc")]).getHash()
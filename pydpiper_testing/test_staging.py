@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+from pydpiper.staging import *
+import os
+import tempfile
+import shutil
+
+class TestStagedOutputs():
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp()
+        self.scratch = os.path.join(self.dir, "scratch")
+        os.mkdir(self.scratch)
+        self.out = os.path.join(self.dir, "out.mnc")
+        self.xfm = os.path.join(self.dir, "out.xfm")
+        self.staged = StagedOutputs(self.scratch, 7, ["tool", self.out, self.xfm, "--clobber"],
+                                    [self.out, self.xfm, os.path.join(self.dir, "implicit.mnc")])
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.dir)
+
+    def test_staged_paths(self):
+        """make sure that only outputs given as arguments (and not transforms) are staged"""
+        assert self.staged.paths.keys() == [self.out]
+        path = self.staged.paths[self.out]
+        assert path.startswith(self.scratch) and path.endswith("out.mnc")
+
+    def test_publish(self):
+        """make sure that published outputs are moved to their final locations"""
+        with open(self.staged.paths[self.out], 'w') as f:
+            f.write("voxels")
+        self.staged.publish()
+        self.staged.remove()
+        assert open(self.out).read() == "voxels"
+        assert os.listdir(self.scratch) == []
+
+class TestInputCache():
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp()
+        self.cache = InputCache(self.dir, budget=150)
+        self.files = []
+        for name in ["atlas.mnc", "mask.mnc", "labels.mnc"]:
+            path = os.path.join(self.dir, name)
+            with open(path, 'w') as f:
+                f.write("x" * 100)
+            self.files.append(path)
+
+    def teardown_method(self, method):
+        self.cache.remove()
+        shutil.rmtree(self.dir)
+
+    def getCopy(self, path):
+        """ask for the file a second time, and for the copy made once it's done"""
+        assert self.cache.get(path) == path
+        self.cache.wait()
+        return self.cache.get(path)
+
+    def test_second_request_cached(self):
+        """make sure that files are copied in the background once they're asked for again"""
+        atlas = self.files[0]
+        assert self.cache.get(atlas) == atlas
+        assert self.cache.get(atlas) == atlas
+        self.cache.wait()
+        copy = self.cache.get(atlas)
+        assert copy != atlas and open(copy).read() == "x" * 100
+        assert self.cache.get(atlas) == copy
+        assert (self.cache.hits, self.cache.misses, self.cache.bytes_saved) == (2, 2, 200)
+        assert os.listdir(self.cache.dir) == [os.path.basename(copy)]
+
+    def test_eviction(self):
+        """make sure that copies in use aren't evicted to stay within the budget"""
+        atlas, mask, _ = self.files
+        self.cache.get(atlas)
+        self.getCopy(atlas)
+        self.cache.get(mask)
+        assert self.cache.get(mask) == mask
+        self.cache.wait()
+        assert self.cache.entries.keys() == [atlas]
+        self.cache.release(atlas)
+        assert self.getCopy(mask) != mask
+        assert self.cache.entries.keys() == [mask]
+        assert self.cache.used == 100
+
+    def test_changed_file(self):
+        """make sure that a file changed since it was copied isn't read from the cache"""
+        atlas = self.files[0]
+        self.cache.get(atlas)
+        self.getCopy(atlas)
+        self.cache.release(atlas)
+        with open(atlas, 'a') as f:
+            f.write("y")
+        assert self.cache.get(atlas) == atlas
+        assert self.cache.used == 0
+
+    def test_changed_file_in_use(self):
+        """make sure that the copy of a changed file isn't replaced while stages are still using it"""
+        atlas = self.files[0]
+        self.cache.get(atlas)
+        copy = self.getCopy(atlas)
+        with open(atlas, 'a') as f:
+            f.write("y")
+        assert self.cache.get(atlas) == atlas
+        assert self.cache.get(atlas) == atlas
+        assert self.cache.entries[atlas].path == copy and os.path.exists(copy)
+        self.cache.release(atlas)
+        assert self.cache.entries[atlas].users == 0
+        # once it's no longer used, the changed file is copied anew
+        assert self.cache.get(atlas) == atlas
+        assert open(self.getCopy(atlas)).read() == "x" * 100 + "y"
+        assert self.cache.used == 101
+
+    def test_requests_bounded(self):
+        """make sure that the files asked for only once don't accumulate without bound"""
+        atlas = self.files[0]
+        for i in range(MAX_TRACKED_REQUESTS + 10):
+            os.utime(atlas, (i, i))
+            self.cache.get(atlas)
+        assert len(self.cache.requests) == MAX_TRACKED_REQUESTS
@@ -13,5 +13,5 @@ setup(name='pydpiper',
       platforms="any",
       packages=['pydpiper', 'applications', 'atoms_and_modules'], 
       data_files=[('config', ['config/MICe.cfg','config/MICe_dev.cfg','config/SciNet.cfg','config/SciNet_debug.cfg'])],
-      scripts=['pydpiper/pipeline_executor.py', 'pydpiper/check_pipeline_status.py', 'applications/MAGeT.py', 'applications/MBM.py', 'applications/registration_chain.py',
+      scripts=['pydpiper/pipeline_executor.py', 'pydpiper/check_pipeline_status.py', 'pydpiper/pipeline_report.py', 'applications/MAGeT.py', 'applications/MBM.py', 'applications/registration_chain.py',
                'applications/twolevel_model_building.py', 'applications/pairwise_nlin.py', 'atoms_and_modules/NLIN.py', 'atoms_and_modules/LSQ12.py', 'atoms_and_modules/LSQ6.py'])